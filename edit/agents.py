@@ -1,7 +1,43 @@
-from utils import get_role_prompt, format_mistral_prompt
-from copy import deepcopy
-import json
-import os
+from utils import get_role_prompt, format_mistral_prompt, num_tokens_from_string
+from metrics import call_metrics, track_call, record_queue_wait
+from tracing import tracer
+from mylogging import my_log
+import contextvars
+import functools
+import threading
+import asyncio
+import time
+
+
+# role and separator tokens the chat format adds to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TruncationStats():
+    # shared by all agents, reported at the end of the job
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.num_acts = 0
+        self.num_truncated = 0
+        self.num_dropped = 0
+
+    def record(self, num_dropped: int = 0) -> None:
+        with self.lock:
+            self.num_acts += 1
+            if num_dropped:
+                self.num_truncated += 1
+                self.num_dropped += num_dropped
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "acts": self.num_acts,
+                "truncated_acts": self.num_truncated,
+                "dropped_messages": self.num_dropped,
+            }
+
+
+truncation_stats = TruncationStats()
 
 
 class LLMAgent():
@@ -9,18 +45,25 @@ class LLMAgent():
                  model,
                  agent_role: str = None,
                  agent_names: dict = None,
-                 api_key: str = None,
+                 key_pool=None,
                  agent_wind_size: int = None,
                  max_agent_len: int = None,
+                 use_async: bool = False,
+                 call_excutor=None,
                  ) -> None:
         self.model = model
-        self.api_key = api_key
+        self.key_pool = key_pool
         self.memory = []
         self.agent_role = agent_role
         self.all_agent_names = agent_names
         self.agent_name = agent_names[agent_role]
         self.agent_wind_size = agent_wind_size
         self.max_agent_len = max_agent_len
+        self.use_async = use_async
+        self.call_excutor = call_excutor
+        self.token_counts = {}
+        # attached to the metrics of every call, see set_tags
+        self.tags = {"role": agent_role, "sample_id": None, "edit_mode": None, "round": None}
         self.__init_agent_role()
 
     def __init_agent_role(self) -> None:
@@ -28,69 +71,75 @@ class LLMAgent():
         self.update_mem(new_mem=role_prompt, role='system')
         self.role_prompt = role_prompt
 
-    def __save_session(self, mem_session, session_name: str = None) -> None:
-        mem_path = os.getcwd() + '/mems/'
-        if not os.path.exists(mem_path):
-            os.makedirs(mem_path)
-        tmp_file = os.path.join(mem_path, session_name)
-        if not os.path.isfile(tmp_file):
-            tmp = []
-        else:
-            with open(tmp_file, 'r') as f:
-                tmp = json.load(f)
-
-        cur_session = {
-            "agent_role": self.agent_role,
-            "agent_name": self.agent_name,
-            "mem_session": mem_session
-        }
-        tmp.append(cur_session)
+    def __get_window(self) -> list:
+        # a shallow list over the memory messages, which are never mutated in place
+        if not self.agent_wind_size:
+            return list(self.memory)
+        # the last agent_wind_size non-system messages, plus every system message
+        cut = len(self.memory)
+        tmp_count = 0
+        while cut > 0 and tmp_count < self.agent_wind_size:
+            cut -= 1
+            if self.memory[cut]["role"] != "system":
+                tmp_count += 1
+        return [mem for mem in self.memory[:cut] if mem["role"] == "system"] + self.memory[cut:]
 
-        with open(tmp_file, 'w') as f:
-            json.dump(tmp, f)
+    def __prepare_query(self) -> tuple[list, dict]:
+        vis_mem = self.__fit_context(self.__get_window())
 
-    def __check_mem(self) -> str:
+        # provider specific formats are applied to the visible window only
+        query_kwargs = {}
         if "glm" in self.model.model_name:
-            self.memory = self.model.check_hist(self.memory)
+            vis_mem = self.model.check_hist(vis_mem)
         elif "ernie" in self.model.model_name:
-            self.memory, _ = self.model.check_hist(self.memory)
-
-    def act(self, session_name: str = None) -> str:
-        self.__check_mem()
-        if (not self.agent_wind_size) or (self.agent_wind_size == 0):
-            vis_mem = deepcopy(self.memory)
-        else:
-            vis_mem = []
-            tmp_count = 0
-            for mem in self.memory[::-1]:
-                if mem["role"] == "system":
-                    vis_mem.append(mem)
-                else:
-                    if tmp_count < self.agent_wind_size:
-                        vis_mem.append(mem)
-                        tmp_count += 1
-                    continue
-            vis_mem = list(reversed(vis_mem))
-        
-        if "ernie" in self.model.model_name:
-            resp = self.model.query(
-                prompt=vis_mem,
-                api_key=self.api_key,
-                system=self.role_prompt
-            )
+            vis_mem, _ = self.model.check_hist(vis_mem)
+            query_kwargs["system"] = self.role_prompt
         elif any(key in self.model.model_name for key in ["mixtral", "mistral"]):
             # mistral/mixtral does not accept "system" prompt
-            vis_mem=format_mistral_prompt(vis_mem)
-            resp = self.model.query(
-                prompt=vis_mem,
-                api_key=self.api_key,
-            )
-        else:
-            resp = self.model.query(
-                prompt=vis_mem,
-                api_key=self.api_key
-            )
-        
+            vis_mem = format_mistral_prompt(vis_mem)
+        return vis_mem, query_kwargs
+
+    def __count_tokens(self, mem: dict = None) -> int:
+        content = mem["content"]
+        if content not in self.token_counts:
+            self.token_counts[content] = num_tokens_from_string(content) + MESSAGE_OVERHEAD_TOKENS
+        return self.token_counts[content]
+
+    def __fit_context(self, vis_mem: list = None) -> list:
+        # drop the oldest turns until the prompt leaves room for the completion,
+        # system prompts and the current request are always kept
+        if not self.max_agent_len:
+            return vis_mem
+        budget = self.max_agent_len - (getattr(self.model, "max_tokens", None) or 0)
+        total = sum(self.__count_tokens(mem) for mem in vis_mem)
+        if total <= budget:
+            truncation_stats.record()
+            return vis_mem
+        fitted = []
+        last_indx = len(vis_mem) - 1
+        for indx, mem in enumerate(vis_mem):
+            if total > budget and mem["role"] != "system" and indx < last_indx:
+                total -= self.__count_tokens(mem)
+                continue
+            fitted.append(mem)
+        # the kept turns must not start with an orphaned assistant reply
+        for indx, mem in enumerate(fitted):
+            if mem["role"] == "system":
+                continue
+            if mem["role"] == "assistant" and indx < len(fitted) - 1:
+                total -= self.__count_tokens(mem)
+                del fitted[indx]
+            break
+        num_dropped = len(vis_mem) - len(fitted)
+        truncation_stats.record(num_dropped)
+        if num_dropped:
+            my_log.info(f"Agent {self.agent_name} dropped {num_dropped} oldest messages to fit "
+                        f"max_agent_len {self.max_agent_len} ({total} prompt tokens)")
+        if total > budget:
+            my_log.warning(f"Agent {self.agent_name} prompt still has {total} tokens > {budget} after truncation")
+        return fitted
+
+    def __trace_action(self, vis_mem: list, resp: str, session=None) -> None:
         # trace every action
         mem_session = vis_mem
         resp_dict = {
@@ -98,11 +147,93 @@ class LLMAgent():
             "content": resp,
         }
         mem_session.append(resp_dict)
-        self.__save_session(mem_session, session_name)
+        session.append({
+            "agent_role": self.agent_role,
+            "agent_name": self.agent_name,
+            "mem_session": mem_session
+        })
         assert resp != "__error__", "An error occurred during model generation."
 
+    def __estimate_tokens(self, vis_mem: list = None) -> int:
+        # token estimates are only needed when keys have a tpm budget
+        if not self.key_pool.tpm_limit:
+            return 0
+        prompt_tokens = sum(self.__count_tokens(mem) for mem in vis_mem)
+        return prompt_tokens + (getattr(self.model, "max_tokens", None) or 0)
+
+    def __observe_call(self, stats=None, vis_mem: list = None, resp: str = None) -> None:
+        if stats is None:
+            return
+        # cached responses and batched calls carry no usage, estimate it with tiktoken
+        if stats.usage_source is None:
+            stats.prompt_tokens = sum(self.__count_tokens(mem) for mem in vis_mem)
+            stats.completion_tokens = num_tokens_from_string(str(resp))
+            stats.usage_source = "tiktoken"
+        stats.error = resp == "__error__"
+        call_metrics.observe(stats, self.tags)
+
+    def act(self, session=None) -> str:
+        vis_mem, query_kwargs = self.__prepare_query()
+        with tracer.span("act", "agent", agent=self.agent_name, **self.tags), track_call() as stats:
+            # a cache hit needs no key, so it never waits on the rpm/tpm budget
+            resp = self.model.probe_cache(prompt=vis_mem, **query_kwargs)
+            if resp is None:
+                lease_t = time.monotonic()
+                with self.key_pool.lease(self.__estimate_tokens(vis_mem)) as api_key:
+                    record_queue_wait(time.monotonic() - lease_t)
+                    resp = self.model.query(
+                        prompt=vis_mem,
+                        api_key=api_key,
+                        **query_kwargs
+                    )
+        self.__observe_call(stats, vis_mem, resp)
+        self.__trace_action(vis_mem, resp, session)
+        return resp
+
+    async def aact(self, session=None) -> str:
+        # agents driven by the thread executor keep the blocking path, run on
+        # the scheduler's shared call executor (not the default executor of the
+        # per-sample event loop) so that independent agents can still overlap
+        if not self.use_async:
+            ctx = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(
+                self.call_excutor, functools.partial(ctx.run, self.act, session))
+        vis_mem, query_kwargs = self.__prepare_query()
+        with tracer.span("act", "agent", agent=self.agent_name, **self.tags), track_call() as stats:
+            resp = None
+            if self.model.cache is not None:
+                resp = await asyncio.to_thread(self.model.probe_cache, prompt=vis_mem, **query_kwargs)
+            if resp is None:
+                lease_t = time.monotonic()
+                async with self.key_pool.alease(self.__estimate_tokens(vis_mem)) as api_key:
+                    record_queue_wait(time.monotonic() - lease_t)
+                    resp = await self.model.aquery(
+                        prompt=vis_mem,
+                        api_key=api_key,
+                        **query_kwargs
+                    )
+        self.__observe_call(stats, vis_mem, resp)
+        self.__trace_action(vis_mem, resp, session)
         return resp
 
+    def fork(self):
+        # a fresh agent with the same role, settings and tags, but its own memory
+        agent = LLMAgent(
+            self.model,
+            agent_role=self.agent_role,
+            agent_names=self.all_agent_names,
+            key_pool=self.key_pool,
+            agent_wind_size=self.agent_wind_size,
+            max_agent_len=self.max_agent_len,
+            use_async=self.use_async,
+            call_excutor=self.call_excutor,
+        )
+        agent.tags = dict(self.tags)
+        return agent
+
+    def set_tags(self, **tags) -> None:
+        self.tags.update(tags)
+
     def update_mem(self, new_mem: str = None, role: str = None, name: str = None) -> None:
         self.memory.append({
             "role": role,
@@ -111,6 +242,7 @@ class LLMAgent():
         )
 
     def clear_mem(self, clear_sys: bool = False) -> None:
+        self.token_counts = {}
         if clear_sys:
             self.memory = []
         else:
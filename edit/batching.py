@@ -0,0 +1,108 @@
+from fastchat.conversation import get_conv_template
+from mylogging import my_log
+import concurrent.futures
+import threading
+import queue
+import time
+
+
+def render_chat_prompt(messages: list[dict[str, str]] = None, template_name: str = None) -> str:
+    # the chat template the server would apply, rendered on the client so that
+    # prompts of different samples can share one completions request
+    conv = get_conv_template(template_name)
+    for msg in messages:
+        if msg["role"] == "system":
+            conv.set_system_message(msg["content"])
+        elif msg["role"] == "user":
+            conv.append_message(conv.roles[0], msg["content"])
+        else:
+            conv.append_message(conv.roles[1], msg["content"])
+    conv.append_message(conv.roles[1], None)
+    return conv.get_prompt()
+
+
+def get_stop_kwargs(template_name: str = None) -> dict:
+    # the server stops chat completions at the template's turn end, raw
+    # completions only stop there when the template's stop settings are sent
+    conv = get_conv_template(template_name)
+    stop_kwargs = {}
+    if conv.stop_str:
+        stop_kwargs["stop"] = [conv.stop_str] if isinstance(conv.stop_str, str) else list(conv.stop_str)
+    if conv.stop_token_ids:
+        # not part of the openai api, passed through to vllm
+        stop_kwargs["extra_body"] = {"stop_token_ids": list(conv.stop_token_ids)}
+    return stop_kwargs
+
+
+class MicroBatcher():
+    # requests arriving within batch_window of the first one are sent together,
+    # the collector keeps gathering the next batch while earlier ones are in flight
+    def __init__(self,
+                 batch_func=None,
+                 max_batch_size: int = 32,
+                 batch_window: float = 0.01,
+                 max_inflight: int = 4,
+                 ) -> None:
+        self.batch_func = batch_func
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.pending = queue.Queue()
+        self.excutor = concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight)
+        self.lock = threading.Lock()
+        self.num_batches = 0
+        self.num_requests = 0
+        self.collector = threading.Thread(target=self.__collect, daemon=True)
+        self.collector.start()
+
+    def submit(self, item=None) -> concurrent.futures.Future:
+        fut = concurrent.futures.Future()
+        self.pending.put((item, fut))
+        return fut
+
+    def __collect(self) -> None:
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.excutor.submit(self.__run_batch, batch)
+
+    def __run_batch(self, batch: list = None) -> None:
+        with self.lock:
+            self.num_batches += 1
+            self.num_requests += len(batch)
+        try:
+            results = self.batch_func([item for item, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        for (_, fut), result in zip(batch, results):
+            fut.set_result(result)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "batches": self.num_batches,
+                "requests": self.num_requests,
+                "avg_batch_size": self.num_requests / self.num_batches if self.num_batches else 0.0,
+            }
+
+
+def get_batcher(args, batch_func=None, max_inflight: int = None) -> MicroBatcher:
+    if not args.batch_generation:
+        return None
+    my_log.info(f"Batching local model requests (window {args.batch_window_ms} ms, "
+                f"max batch size {args.max_batch_size}, template {args.chat_template})")
+    return MicroBatcher(
+        batch_func,
+        max_batch_size=args.max_batch_size,
+        batch_window=args.batch_window_ms / 1000,
+        max_inflight=max_inflight
+    )
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI
+import argparse
+import statistics
+import time
+
+from models import LocalModel
+from mock_server import start_server
+
+
+# Measures the per-request client overhead of a fresh OpenAI client per call
+# (the old behaviour of LocalModel/ProxyGPTModel) against the pooled client,
+# using the local mock server so that only client-side costs are compared.
+
+
+PROMPT = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "Say something."},
+]
+
+
+def query_fresh_client(args) -> str:
+    client = OpenAI(api_key="EMPTY", base_url=args.proxy_api_url)
+    completion = client.chat.completions.create(
+        model=args.model_name,
+        max_tokens=args.max_tokens,
+        messages=PROMPT
+    )
+    return completion.choices[0].message.content
+
+
+def run_bench(name: str = None, query_func=None, args=None) -> dict:
+    latencies = []
+
+    def timed_query(_):
+        start_t = time.perf_counter()
+        query_func()
+        latencies.append(time.perf_counter() - start_t)
+
+    # warm up connections so both variants are measured in steady state
+    for _ in range(min(args.concurrency, 8)):
+        query_func()
+    start_t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as excutor:
+        list(excutor.map(timed_query, range(args.num_requests)))
+    total_t = time.perf_counter() - start_t
+
+    latencies.sort()
+    return {
+        "name": name,
+        "req/s": args.num_requests / total_t,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxy_api_url", type=str, default=None,
+                        help="OpenAI-compatible endpoint. If not set, a local mock server is started.")
+    parser.add_argument("--model_name", type=str, default="mock")
+    parser.add_argument("--num_requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the mock server takes per request.")
+    parser.add_argument("--batch_generation", action='store_true',
+                        help="Also measure the batched completions client (requires fastchat).")
+    parser.add_argument("--batch_window_ms", type=float, default=10)
+    parser.add_argument("--chat_template", type=str, default="mistral")
+    args = parser.parse_args()
+
+    server = None
+    if args.proxy_api_url is None:
+        server = start_server(latency=args.latency)
+        args.proxy_api_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    model_args = argparse.Namespace(
+        proxy_api_url=args.proxy_api_url,
+        model_name=args.model_name,
+        use_local_model=True,
+        max_tokens=16,
+        completion_number=1,
+        temperature=0.0,
+        top_p=1.0,
+        num_workers=args.concurrency,
+        # one call per worker
+        sched_mode="sample",
+        edit_mode=["0"],
+        pool_size=None,
+        keepalive_expiry=30.0,
+        max_retries=2,
+        retry_base_delay=1.0,
+        retry_max_delay=60.0,
+        adaptive_concurrency=False,
+        cache_path=None,
+        batch_generation=False,
+        batch_window_ms=args.batch_window_ms,
+        max_batch_size=args.concurrency,
+        chat_template=args.chat_template,
+    )
+    args.max_tokens = model_args.max_tokens
+    model = LocalModel(model_args)
+
+    results = [
+        run_bench("fresh client per call", lambda: query_fresh_client(args), args),
+        run_bench("pooled client", lambda: model.query(PROMPT), args),
+    ]
+    if args.batch_generation:
+        model_args.batch_generation = True
+        batched_model = LocalModel(model_args)
+        results.append(run_bench("batched client", lambda: batched_model.query(PROMPT), args))
+    for res in results:
+        print("{name:<24} {req/s:>9.1f} req/s  mean {mean_ms:>7.2f} ms  p50 {p50_ms:>7.2f} ms  p99 {p99_ms:>7.2f} ms".format_map(res))
+
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import tempfile
+import jsonlines
+import gzip
+import json
+import time
+import os
+
+from dataloader import SFTDataLoader, zstandard
+
+
+# Measures the startup time of SFTDataLoader (until the first sample of the
+# requested range is parsed) on a synthetic sharegpt dataset, against the old
+# loader which parsed the whole file and fell back to jsonl on failure.
+
+
+def gen_sample(indx: int = None, num_turns: int = 3) -> dict:
+    conversations = []
+    for turn in range(num_turns):
+        conversations.append({"from": "human", "value": f"Question {turn} of sample {indx}: " + "tell me more [about] {this}. " * 8})
+        conversations.append({"from": "gpt", "value": f"Answer {turn} of sample {indx}: " + "here is a \"detailed\" answer. " * 40})
+    return {"conversations": conversations}
+
+
+def write_datasets(work_dir: str = None, num_samples: int = None) -> list[str]:
+    json_path = os.path.join(work_dir, "bench.json")
+    jsonl_path = os.path.join(work_dir, "bench.jsonl")
+    with open(json_path, 'w') as f_json, open(jsonl_path, 'w') as f_jsonl:
+        f_json.write("[")
+        for indx in range(num_samples):
+            line = json.dumps(gen_sample(indx))
+            f_json.write(("," if indx else "") + line)
+            f_jsonl.write(line + "\n")
+        f_json.write("]")
+    paths = [json_path, jsonl_path]
+    with open(jsonl_path, 'rb') as f_in, gzip.open(jsonl_path + ".gz", 'wb', compresslevel=6) as f_out:
+        f_out.write(f_in.read())
+    paths.append(jsonl_path + ".gz")
+    if zstandard is not None:
+        with open(jsonl_path, 'rb') as f_in, open(jsonl_path + ".zst", 'wb') as f_out:
+            f_out.write(zstandard.ZstdCompressor().compress(f_in.read()))
+        paths.append(jsonl_path + ".zst")
+    return paths
+
+
+def legacy_load(path: str = None) -> list[dict]:
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except Exception:
+        with jsonlines.open(path, 'r') as reader:
+            return [item for item in reader]
+
+
+def time_loader(path: str = None, start_indx: int = None) -> float:
+    args = argparse.Namespace(
+        root_path=os.path.dirname(path),
+        dataset_name=os.path.basename(path),
+        dataset_format="sharegpt",
+        start_indx=start_indx,
+        end_indx=None,
+    )
+    start_t = time.perf_counter()
+    data = SFTDataLoader(args)
+    next(data)
+    return time.perf_counter() - start_t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_samples", type=int, default=200000,
+                        help="Number of synthetic sharegpt samples.")
+    parser.add_argument("--start_indx", type=int, default=0,
+                        help="Start indx of the loaded range.")
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="Where the synthetic datasets are written (default: a temp dir).")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_loader_")
+    os.makedirs(work_dir, exist_ok=True)
+    paths = write_datasets(work_dir, args.num_samples)
+    print(f"{'dataset':<20}{'MB':>10}{'legacy_s':>12}{'index_s':>12}{'cached_s':>12}")
+    for path in paths:
+        size_mb = os.path.getsize(path) / 2**20
+        if path.endswith((".json", ".jsonl")):
+            start_t = time.perf_counter()
+            legacy_load(path)
+            legacy_t = f"{time.perf_counter() - start_t:.3f}"
+        else:
+            legacy_t = "-"
+        if os.path.exists(path + ".idx"):
+            os.remove(path + ".idx")
+        index_t = time_loader(path, args.start_indx)
+        cached_t = time_loader(path, args.start_indx)
+        print(f"{os.path.basename(path):<20}{size_mb:>10.1f}{legacy_t:>12}{index_t:>12.3f}{cached_t:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
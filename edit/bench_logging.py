@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import argparse
+import tempfile
+import logging
+import time
+import os
+
+from mylogging import LOG_FORMAT, BRIEF_RESP_CHARS, get_file_handler, get_queue_handler
+
+
+# Measures how long worker threads are blocked in logger.info when every agent
+# response is logged: the old synchronous FileHandler (each call takes the
+# handler lock and writes to disk) against the queue handler with a background
+# writer, with full and brief responses.
+
+
+RESP = "Here is a detailed and helpful response to the instruction. " * 40
+
+
+def get_sync_logger(logfile: str = None) -> tuple[logging.Logger, None]:
+    logger = logging.getLogger("bench_sync_" + logfile)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    file_handler = logging.FileHandler(logfile, encoding='UTF-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(file_handler)
+    return logger, None
+
+
+def get_async_logger(logfile: str = None) -> tuple[logging.Logger, object]:
+    logger = logging.getLogger("bench_queue_" + logfile)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    queue_handler, listener = get_queue_handler([get_file_handler(logfile, 100 * 2**20, 5)])
+    logger.addHandler(queue_handler)
+    listener.start()
+    return logger, listener
+
+
+def run_bench(name: str = None, get_logger=None, resp: str = None, num_workers: int = None,
+              num_records: int = None, work_dir: str = None) -> dict:
+    logfile = os.path.join(work_dir, f"{name.replace(' ', '_')}_{num_workers}.log")
+    logger, listener = get_logger(logfile)
+    per_worker = num_records // num_workers
+
+    def worker(_):
+        latencies = []
+        for _ in range(per_worker):
+            start_t = time.perf_counter()
+            logger.info(resp)
+            latencies.append(time.perf_counter() - start_t)
+        return latencies
+
+    start_t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_workers) as excutor:
+        latencies = [t for res in excutor.map(worker, range(num_workers)) for t in res]
+    total_t = time.perf_counter() - start_t
+    # the time until every record is on disk
+    if listener is not None:
+        listener.stop()
+    drain_t = time.perf_counter() - start_t
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+
+    latencies.sort()
+    return {
+        "name": name,
+        "workers": num_workers,
+        "records/s": len(latencies) / total_t,
+        "mean_us": statistics.mean(latencies) * 1e6,
+        "p99_us": latencies[int(len(latencies) * 0.99) - 1] * 1e6,
+        "drain_s": drain_t,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_workers", nargs='+', type=int, default=[1, 16, 100],
+                        help="Numbers of logging threads to benchmark.")
+    parser.add_argument("--num_records", type=int, default=20000,
+                        help="Number of logged responses per run.")
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="Where the log files are written (default: a temp dir).")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_logging_")
+    os.makedirs(work_dir, exist_ok=True)
+    brief_resp = f"{RESP[:BRIEF_RESP_CHARS]}... ({len(RESP)} chars)"
+    for num_workers in args.num_workers:
+        results = [
+            run_bench("sync file handler", get_sync_logger, RESP, num_workers, args.num_records, work_dir),
+            run_bench("queue handler", get_async_logger, RESP, num_workers, args.num_records, work_dir),
+            run_bench("queue handler brief", get_async_logger, brief_resp, num_workers, args.num_records, work_dir),
+        ]
+        for res in results:
+            print("{name:<22} {workers:>4} workers {records/s:>10.0f} records/s  "
+                  "mean {mean_us:>8.1f} us  p99 {p99_us:>8.1f} us  drained in {drain_s:.2f}s".format_map(res))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import subprocess
+import argparse
+import tempfile
+import shlex
+import json
+import time
+import sys
+import os
+
+from mock_server import start_server
+
+
+# End-to-end throughput of main.py against the local mock server: for every
+# worker count the whole job runs as a subprocess over a synthetic dataset, so
+# what is measured is the scheduler/agent/client overhead on top of the
+# simulated model latency. Per-sample latencies come from the result manifest,
+# CPU time and peak RSS of the job from os.wait4.
+
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def gen_alpaca_sample(indx: int = None) -> dict:
+    return {
+        "instruction": f"Explain topic {indx} in a few sentences.",
+        "input": "" if indx % 2 else f"Some context about topic {indx}. " * 4,
+        "output": f"Topic {indx} is about " + "a detailed and helpful answer. " * 12,
+    }
+
+
+def gen_sharegpt_sample(indx: int = None, num_turns: int = 2) -> dict:
+    conversations = []
+    for turn in range(num_turns):
+        conversations.append({"from": "human", "value": f"Question {turn} of sample {indx}: " + "tell me more about it. " * 6})
+        conversations.append({"from": "gpt", "value": f"Answer {turn} of sample {indx}: " + "here is a detailed answer. " * 20})
+    return {"id": f"bench_{indx}", "conversations": conversations}
+
+
+def write_dataset(data_dir: str = None, dataset_format: str = None, num_samples: int = None, num_turns: int = None) -> str:
+    os.makedirs(data_dir, exist_ok=True)
+    dataset_name = f"bench_{dataset_format}.json"
+    if dataset_format == "alpaca":
+        samples = [gen_alpaca_sample(indx) for indx in range(num_samples)]
+    else:
+        samples = [gen_sharegpt_sample(indx, num_turns) for indx in range(num_samples)]
+    with open(os.path.join(data_dir, dataset_name), 'w') as f:
+        json.dump(samples, f)
+    return dataset_name
+
+
+def percentile(values: list = None, q: float = None) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(len(values) * q) - 1))]
+
+
+def load_manifest(res_dir: str = None) -> list[dict]:
+    entries = []
+    manifest_path = os.path.join(res_dir, "_manifest.jsonl")
+    if not os.path.isfile(manifest_path):
+        return entries
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def run_job(args, work_dir: str = None, dataset_name: str = None, num_workers: int = None) -> dict:
+    save_folder_name = f"bench_{args.dataset_format}_w{num_workers}"
+    cmd = [
+        sys.executable, args.main_path,
+        "--use_local_model",
+        "--proxy_api_url", args.proxy_api_url,
+        "--model_name", args.model_name,
+        "--root_path", "data/",
+        "--dataset_name", dataset_name,
+        "--dataset_format", args.dataset_format,
+        "--num_workers", str(num_workers),
+        "--save_folder_name", save_folder_name,
+        "--edit_mode", *args.edit_mode,
+    ]
+    if args.use_async:
+        cmd.append("--use_async")
+    cmd += shlex.split(args.main_args)
+
+    # main.py writes logs and results below its working directory
+    start_t = time.perf_counter()
+    with open(os.path.join(work_dir, save_folder_name + ".out"), 'w') as out:
+        proc = subprocess.Popen(cmd, cwd=work_dir, stdout=out, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    wall_t = time.perf_counter() - start_t
+    # reaped by wait4 already, tell Popen so it does not wait again
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    entries = load_manifest(os.path.join(work_dir, "res", save_folder_name))
+    latencies = [entry["elapsed"] for entry in entries if entry.get("elapsed") is not None]
+    return {
+        "workers": num_workers,
+        "exit": proc.returncode,
+        "samples": len(entries),
+        "errors": sum(entry["status"] != "ok" for entry in entries),
+        "wall_s": wall_t,
+        "samples/s": len(entries) / wall_t,
+        "p50_s": percentile(latencies, 0.5),
+        "p99_s": percentile(latencies, 0.99),
+        "cpu_s": rusage.ru_utime + rusage.ru_stime,
+        # ru_maxrss is in KB on linux
+        "rss_mb": rusage.ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxy_api_url", type=str, default=None,
+                        help="OpenAI-compatible endpoint. If not set, a local mock server is started.")
+    parser.add_argument("--model_name", type=str, default="mixtral")
+    parser.add_argument("--main_path", type=str, default=MAIN_PATH,
+                        help="The entry point to benchmark.")
+    parser.add_argument("--main_args", type=str, default="",
+                        help="Extra arguments passed to main.py, e.g. \"--sched_mode stage\".")
+    parser.add_argument("--dataset_format", type=str, default="alpaca",
+                        choices=["alpaca", "sharegpt"])
+    parser.add_argument("--num_samples", type=int, default=100,
+                        help="Number of synthetic samples per job.")
+    parser.add_argument("--num_turns", type=int, default=2,
+                        help="Number of turns of the synthetic sharegpt samples.")
+    parser.add_argument("--num_workers", nargs='+', type=int, default=[1, 4, 16],
+                        help="Worker counts to benchmark, one job each.")
+    parser.add_argument("--use_async", action='store_true')
+    parser.add_argument("--edit_mode", nargs='+', type=str, default=["4"])
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="Where data, logs and results are written (default: a temp dir).")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Mock server latency per request in seconds.")
+    parser.add_argument("--latency_dist", type=str, default="lognormal",
+                        choices=["fixed", "uniform", "exp", "lognormal"])
+    parser.add_argument("--tokens_per_sec", type=float, default=None)
+    parser.add_argument("--completion_tokens", type=int, default=32)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--throttle_rate", type=float, default=0.0)
+    parser.add_argument("--retry_after", type=float, default=0.1)
+    parser.add_argument("--judge_output", type=str, default="<assistant 2>")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = None
+    if args.proxy_api_url is None:
+        server = start_server(
+            latency=args.latency,
+            latency_dist=args.latency_dist,
+            tokens_per_sec=args.tokens_per_sec,
+            completion_tokens=args.completion_tokens,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            retry_after=args.retry_after,
+            judge_output=args.judge_output,
+            seed=args.seed,
+        )
+        args.proxy_api_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_pipeline_")
+    os.makedirs(work_dir, exist_ok=True)
+    dataset_name = write_dataset(
+        os.path.join(work_dir, "data"), args.dataset_format, args.num_samples, args.num_turns)
+    print(f"Writing to {work_dir}, mock server at {args.proxy_api_url}")
+
+    print(f"{'workers':>8}{'samples':>9}{'errors':>8}{'wall_s':>9}{'samples/s':>11}"
+          f"{'p50_s':>8}{'p99_s':>8}{'cpu_s':>8}{'rss_mb':>8}")
+    for num_workers in args.num_workers:
+        res = run_job(args, work_dir, dataset_name, num_workers)
+        print("{workers:>8}{samples:>9}{errors:>8}{wall_s:>9.2f}{samples/s:>11.2f}"
+              "{p50_s:>8.2f}{p99_s:>8.2f}{cpu_s:>8.2f}{rss_mb:>8.1f}".format_map(res))
+        if res["exit"] != 0:
+            print(f"main.py exited with {res['exit']}, see {work_dir}/bench_{args.dataset_format}_w{num_workers}.out")
+
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
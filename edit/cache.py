@@ -0,0 +1,133 @@
+from mylogging import my_log
+import threading
+import hashlib
+import asyncio
+import sqlite3
+import time
+import json
+import os
+
+
+class ResponseCache():
+    def __init__(self, path: str = None, max_bytes: int = None) -> None:
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # one connection shared by all workers, serialized by the lock
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(**fields) -> str:
+        payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str = None, count_miss: bool = True) -> str:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += count_miss
+                return None
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str = None, response: str = None) -> None:
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.max_bytes and self.total_bytes > self.max_bytes:
+                self.__evict()
+
+    def __evict(self) -> None:
+        # drop least recently used entries until 90% of the budget is free again
+        target = int(self.max_bytes * 0.9)
+        rows = self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size_mb": self.total_bytes / 2**20,
+            }
+
+
+caches = {}
+
+
+def get_response_cache(args) -> ResponseCache:
+    # sampled generations are not reproducible, only cache deterministic decoding
+    if not args.cache_path or args.temperature != 0:
+        return None
+    if args.cache_path not in caches:
+        max_bytes = int(args.cache_max_mb * 2**20) if args.cache_max_mb else None
+        caches[args.cache_path] = ResponseCache(args.cache_path, max_bytes)
+        my_log.info(f"Using response cache at {args.cache_path}")
+    return caches[args.cache_path]
+
+
+def cached_query(cache: ResponseCache = None, cache_key: str = None, query_func=None, *args, **kwargs) -> str:
+    if cache is None:
+        return query_func(*args, **kwargs)
+    response = cache.get(cache_key)
+    if response is None:
+        response = query_func(*args, **kwargs)
+        if isinstance(response, str) and response != "__error__":
+            cache.put(cache_key, response)
+    return response
+
+
+async def acached_query(cache: ResponseCache = None, cache_key: str = None, query_func=None, *args, **kwargs) -> str:
+    if cache is None:
+        return await query_func(*args, **kwargs)
+    # sqlite reads (and the last_access update of a hit) stay off the event loop
+    response = await asyncio.to_thread(cache.get, cache_key)
+    if response is None:
+        response = await query_func(*args, **kwargs)
+        if isinstance(response, str) and response != "__error__":
+            await asyncio.to_thread(cache.put, cache_key, response)
+    return response
+
+
+def probe_cache(cache: ResponseCache = None, cache_key: str = None) -> str:
+    # the cached response if any, looked up before the agent leases a key so
+    # that hits spend no rpm/tpm budget; a miss is counted by the query itself
+    if cache is None:
+        return None
+    return cache.get(cache_key, count_miss=False)
@@ -0,0 +1,199 @@
+from retry import get_status_code, is_retryable
+from metrics import record_queue_wait
+from pipeline import get_stage_workers
+from mylogging import my_log
+from collections import deque
+import threading
+import math
+import asyncio
+import time
+
+
+class NullLimiter():
+    # used when adaptive concurrency is off: --num_workers alone bounds the requests
+    limit = None
+
+    def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    async def arun(self, func, *args, **kwargs):
+        return await func(*args, **kwargs)
+
+
+class AdaptiveLimiter():
+    def __init__(self,
+                 init_limit: int = 4,
+                 min_limit: int = 1,
+                 max_limit: int = 64,
+                 latency_tolerance: float = 2.0,
+                 backoff_ratio: float = 0.5,
+                 window: int = 32,
+                 cooldown: float = 1.0,
+                 ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(init_limit, min_limit), max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        # latencies since the last check, judged once per full window
+        self.window = window
+        self.latencies = []
+        self.cooldown = cooldown
+        # p90 latency of the healthy windows
+        self.baseline_latency = None
+        self.last_backoff_t = 0.0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.async_waiters = deque()
+
+    # slot management
+
+    def __has_slot(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def acquire(self) -> float:
+        start_t = time.monotonic()
+        with self.cond:
+            while not self.__has_slot():
+                self.cond.wait()
+            self.in_flight += 1
+        return time.monotonic() - start_t
+
+    async def aacquire(self) -> float:
+        start_t = time.monotonic()
+        with self.lock:
+            if self.__has_slot():
+                self.in_flight += 1
+                return time.monotonic() - start_t
+            fut = asyncio.get_running_loop().create_future()
+            self.async_waiters.append(fut)
+        # the slot is reserved for us by __wake_waiters before the future resolves
+        await fut
+        return time.monotonic() - start_t
+
+    def release(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            self.__wake_waiters()
+
+    def __wake_waiters(self) -> None:
+        # called with the lock held, whenever a slot frees up or the limit grows
+        while self.async_waiters and self.__has_slot():
+            fut = self.async_waiters.popleft()
+            self.in_flight += 1
+            fut.get_loop().call_soon_threadsafe(self.__resolve_waiter, fut)
+        self.cond.notify_all()
+
+    def __resolve_waiter(self, fut: asyncio.Future = None) -> None:
+        if fut.done():
+            # the waiter was cancelled meanwhile, hand its slot back
+            self.release()
+        else:
+            fut.set_result(None)
+
+    # AIMD feedback
+
+    def __set_limit(self, new_limit: float = None, reason: str = None) -> None:
+        new_limit = min(max(new_limit, self.min_limit), self.max_limit)
+        if int(new_limit) != int(self.limit):
+            my_log.info(f"Concurrency limit {int(self.limit)} -> {int(new_limit)} ({reason})")
+        self.limit = new_limit
+        self.__wake_waiters()
+
+    def __backoff(self, reason: str = None) -> None:
+        # back off at most once per cooldown (and round trip), a burst of
+        # errors or a slow window right after a backoff only halves the limit once
+        now = time.monotonic()
+        if now - self.last_backoff_t < max(self.cooldown, self.baseline_latency or 0.0):
+            return
+        self.last_backoff_t = now
+        # the next window starts from the new limit
+        self.latencies = []
+        self.__set_limit(self.limit * self.backoff_ratio, reason)
+
+    def on_success(self, latency: float = None) -> None:
+        with self.lock:
+            # only grow while the limit is actually the bottleneck,
+            # +1 per limit-many successes
+            if self.in_flight >= int(self.limit):
+                self.__set_limit(self.limit + 1 / self.limit, "healthy")
+            self.latencies.append(latency)
+            if len(self.latencies) < self.window:
+                return
+            # the p90 of a whole window against the p90 of the healthy ones:
+            # the tail of a healthy backend stays within the tolerance, only
+            # a slowdown of at least a tenth of the calls backs off
+            self.latencies.sort()
+            window_p90 = self.latencies[math.ceil(0.9 * len(self.latencies)) - 1]
+            self.latencies = []
+            if self.baseline_latency is None:
+                self.baseline_latency = window_p90
+            elif window_p90 > self.latency_tolerance * self.baseline_latency:
+                self.__backoff(f"p90 latency {window_p90:.2f}s > {self.latency_tolerance}x baseline {self.baseline_latency:.2f}s")
+            else:
+                # slowly track the healthy latency level
+                self.baseline_latency = 0.8 * self.baseline_latency + 0.2 * window_p90
+
+    def on_error(self, e: Exception = None) -> None:
+        status_code = get_status_code(e)
+        overloaded = (status_code == 429) or (status_code is not None and status_code >= 500) \
+            or (status_code is None and is_retryable(e))
+        if overloaded:
+            with self.lock:
+                self.__backoff(f"{status_code or type(e).__name__}")
+
+    def run(self, func, *args, **kwargs):
+        record_queue_wait(self.acquire())
+        start_t = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.on_error(e)
+            raise
+        else:
+            self.on_success(time.monotonic() - start_t)
+            return result
+        finally:
+            self.release()
+
+    async def arun(self, func, *args, **kwargs):
+        record_queue_wait(await self.aacquire())
+        start_t = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            self.on_error(e)
+            raise
+        else:
+            self.on_success(time.monotonic() - start_t)
+            return result
+        finally:
+            self.release()
+
+
+def get_sample_fanout(edit_mode: list = None) -> int:
+    # model calls one sample has in flight at once: the edit modes run
+    # concurrently, as do the debaters of mode 3 and the debaters and
+    # judge orders of mode 4 (which runs alone)
+    if "4" in edit_mode:
+        return 2
+    return max(1, sum(2 if mode == "3" else 1 for mode in ["0", "1", "2", "3"] if mode in edit_mode))
+
+
+def get_max_inflight(args) -> int:
+    # upper bound of the model calls in flight across the job
+    if args.sched_mode == "stage":
+        return sum(get_stage_workers(args).values())
+    return args.num_workers * get_sample_fanout(args.edit_mode)
+
+
+def get_limiter(args):
+    if not args.adaptive_concurrency:
+        return NullLimiter()
+    max_limit = args.max_concurrency if args.max_concurrency else get_max_inflight(args)
+    return AdaptiveLimiter(
+        init_limit=max(args.min_concurrency, max_limit // 4),
+        min_limit=args.min_concurrency,
+        max_limit=max_limit,
+    )
@@ -1,13 +1,14 @@
+from sink import iter_results
+from utils import get_encoding
 from tqdm import tqdm
 import jsonlines
-import tiktoken
 import json
 import os
 
 
 def num_tokens_from_string(string: str=None, disallowed_special=False):
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    encoding = get_encoding()
     if disallowed_special:
         num_tokens = len(encoding.encode(string, disallowed_special=()))
     else:
@@ -59,8 +60,7 @@ def gen_multi_conv_train_dataset(res_name: str = None, output_format="json"):
         3:0
     }
 
-    for f_name in tqdm(os.listdir(res_path)):
-        res = json_load(os.path.join(res_path, f_name))
+    for res in tqdm(iter_results(res_path)):
         total_count += 1
         if "edit_error" in res:
             error_count+=1
@@ -119,8 +119,7 @@ def gen_single_conv_train_dataset(res_name: str = None, output_format="json", da
         3:0
     }
 
-    for f_name in tqdm(os.listdir(res_path)):
-        res = json_load(os.path.join(res_path, f_name))
+    for res in tqdm(iter_results(res_path)):
         total_count += 1
         if "edit_error" in res:
             error_count += 1
@@ -203,8 +202,7 @@ def gen_ablation_train_dataset(res_name: str=None):
     error_count=0
 
 
-    for f_name in tqdm(os.listdir(res_path)):
-        res = json_load(os.path.join(res_path, f_name))
+    for res in tqdm(iter_results(res_path)):
         total_count += 1
         sum_ori_resp_len += num_tokens_from_string(res["output"], disallowed_special=True)
         for m in ["0","1","2","3"]:
@@ -1,21 +1,123 @@
 from mylogging import my_log
-import jsonlines
+from array import array
+import functools
+import mmap
+import gzip
 import json
+import re
+import io
 import os
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def json_load(path):
-    with open(path, 'r') as file:
-        tmp = json.load(file)
-    return tmp
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
+# a whole string token (so brackets inside strings are skipped) or a bracket
+JSON_TOKEN_PATTERN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+# a line with at least one non-whitespace byte
+JSONL_LINE_PATTERN = re.compile(rb'^.*\S.*$', re.M)
 
-def jsonl_load(f):
-    data = []
-    with jsonlines.open(f, 'r') as reader:
-        for item in reader:
-            data.append(item)
-    return data
+
+def scan_json_array(buf) -> tuple[array, array]:
+    # byte offsets of the objects within a top-level json array, without parsing them
+    starts, ends = array('q'), array('q')
+    depth = 0
+    for m in JSON_TOKEN_PATTERN.finditer(buf):
+        c = buf[m.start()]
+        if c == 0x22:
+            continue
+        if c == 0x7b or c == 0x5b:
+            depth += 1
+            if depth == 2 and c == 0x7b:
+                starts.append(m.start())
+        else:
+            depth -= 1
+            if depth == 1 and c == 0x7d:
+                ends.append(m.end())
+    return starts, ends
+
+
+def scan_jsonl(buf) -> tuple[array, array]:
+    starts, ends = array('q'), array('q')
+    for m in JSONL_LINE_PATTERN.finditer(buf):
+        starts.append(m.start())
+        ends.append(m.end())
+    return starts, ends
+
+
+def scan_jsonl_stream(stream=None) -> tuple[array, array]:
+    # offsets within the decompressed stream
+    starts, ends = array('q'), array('q')
+    pos = 0
+    for line in stream:
+        record = line.rstrip(b"\r\n")
+        if record.strip():
+            starts.append(pos)
+            ends.append(pos + len(record))
+        pos += len(line)
+    return starts, ends
+
+
+def is_json_array(head: bytes = None) -> bool:
+    # a json dataset is one top-level array, a jsonl dataset starts with an object
+    for c in head:
+        if c not in b" \t\r\n\xef\xbb\xbf":
+            return c == 0x5b
+    return False
+
+
+def open_stream(file_path: str = None, compression: str = None):
+    if compression is None:
+        return open(file_path, 'rb')
+    if compression == "gzip":
+        return gzip.open(file_path, 'rb')
+    if zstandard is None:
+        raise ImportError("Loading zstd compressed data requires `pip install zstandard`.")
+    reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    return io.BufferedReader(reader)
+
+
+def sniff_format(file_path: str = None) -> tuple[str, bool]:
+    # the compression from the magic bytes, then json array vs jsonl
+    # from the first bytes of the (decompressed) content
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        compression = "gzip"
+    elif magic.startswith(ZSTD_MAGIC):
+        compression = "zstd"
+    else:
+        compression = None
+    with open_stream(file_path, compression) as f:
+        head = f.read(4096)
+    return compression, is_json_array(head)
+
+
+def load_offset_index(file_path: str = None, scan_func=None) -> tuple[array, array]:
+    # the index is cached next to the dataset and rebuilt whenever the file changes
+    idx_path = file_path + ".idx"
+    stat = os.stat(file_path)
+    header = array('q', [stat.st_size, stat.st_mtime_ns])
+    if os.path.isfile(idx_path):
+        cached = array('q')
+        with open(idx_path, 'rb') as f:
+            cached.frombytes(f.read())
+        if cached[:2] == header:
+            num = (len(cached) - 2) // 2
+            return cached[2:2+num], cached[2+num:]
+
+    starts, ends = scan_func()
+    try:
+        with open(idx_path + ".tmp", 'wb') as f:
+            (header + starts + ends).tofile(f)
+        os.replace(idx_path + ".tmp", idx_path)
+    except OSError as e:
+        my_log.warning(f"Failed to cache data index at {idx_path}: {e}")
+    return starts, ends
 
 
 class SFTDataLoader(object):
@@ -24,46 +126,87 @@ class SFTDataLoader(object):
             args.root_path, args.dataset_name)
         self.format=args.dataset_format
         if self.format=="alpaca":
-            self.data = self.__load_alpaca_data()
-        elif self.format=="sharegpt":  
-            self.data = self.__load_sharegpt_data()
+            my_log.info("Loading data with alpaca format...")
+        elif self.format=="sharegpt":
+            my_log.info("Loading data with sharegpt format...")
         else:
             raise NotImplementedError
+        self.__load_data()
         self.indx = args.start_indx
-        self.end_indx = len(self.data) if args.end_indx is None \
-            else args.end_indx
-        if "id" not in self.data[0]:
-            self.__assign_sample_id()
-
-    def __load_alpaca_data(self) -> tuple[list[dict], set]:
-        my_log.info("Loading data with alpaca format...")
-        try:
-            return json_load(self.file_path)
-        except Exception as e:
-            return jsonl_load(self.file_path)
-    
-    def __load_sharegpt_data(self) -> tuple[list[dict], set]:
-        my_log.info("Loading data with sharegpt format...")
-        try:
-            return json_load(self.file_path)
-        except Exception as e:
-            return jsonl_load(self.file_path)
-
-    def __assign_sample_id(self):
-        for indx, sample in enumerate(self.data):
+        self.end_indx = len(self) if args.end_indx is None \
+            else min(args.end_indx, len(self))
+        # samples without an id get their position within the dataset
+        self.assign_id = len(self) > 0 and "id" not in self.__parse(0)
+
+    def __load_data(self) -> None:
+        # samples are parsed on demand, only their byte offsets are kept in memory
+        self.compression, is_array = sniff_format(self.file_path)
+        self.stream = None
+        self.stream_pos = 0
+        if self.compression is None:
+            with open(self.file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    self.buf = b""
+                else:
+                    self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        elif is_array:
+            # a compressed json array has no random access, it is inflated into memory
+            with open_stream(self.file_path, self.compression) as f:
+                self.buf = f.read()
+        else:
+            # compressed jsonl is read as a stream, samples are pulled in order
+            self.buf = None
+        self.starts, self.ends = load_offset_index(
+            self.file_path, functools.partial(self.__scan, is_array))
+        my_log.info(f"Indexed {len(self.starts)} samples of {self.file_path} "
+                    f"({'json' if is_array else 'jsonl'}, compression: {self.compression})")
+
+    def __scan(self, is_array: bool = None) -> tuple[array, array]:
+        if self.buf is None:
+            with open_stream(self.file_path, self.compression) as f:
+                return scan_jsonl_stream(f)
+        if is_array:
+            return scan_json_array(self.buf)
+        return scan_jsonl(self.buf)
+
+    def __read_stream(self, start: int = None, end: int = None) -> bytes:
+        # forward reads only, going back re-opens the stream
+        if self.stream is None or start < self.stream_pos:
+            if self.stream is not None:
+                self.stream.close()
+            self.stream = open_stream(self.file_path, self.compression)
+            self.stream_pos = 0
+        while self.stream_pos < start:
+            chunk = self.stream.read(min(start - self.stream_pos, 2**20))
+            if not chunk:
+                break
+            self.stream_pos += len(chunk)
+        record = self.stream.read(end - start)
+        self.stream_pos = end
+        return record
+
+    def __parse(self, indx: int = None) -> dict:
+        if self.buf is None:
+            return json.loads(self.__read_stream(self.starts[indx], self.ends[indx]))
+        return json.loads(self.buf[self.starts[indx]:self.ends[indx]])
+
+    def __getitem__(self, indx: int = None) -> dict:
+        sample = self.__parse(indx)
+        if self.assign_id:
             tmp = {"id" : indx}
             tmp.update(sample)
-            self.data[indx]=tmp
+            sample = tmp
+        return sample
 
     def __len__(self):
-        return len(self.data)
+        return len(self.starts)
 
     def __iter__(self):
         return self
 
     def __next__(self):
         if self.indx < self.end_indx:
-            cur_sample = self.data[self.indx]
+            cur_sample = self[self.indx]
             self.indx += 1
             return self.indx, cur_sample
         else:
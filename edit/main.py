@@ -1,6 +1,6 @@
 from scheduler import ConCurAgentScheduler
 from utils import get_mem_path, get_res_path, get_error_path, save_args
-from mylogging import my_log, save_log_path
+from mylogging import my_log, save_log_path, configure as configure_logging
 import argparse
 import json
 
@@ -15,6 +15,34 @@ def parse_args():
                         help="Whether to save agent memory file (default path: ../mems/).")
     parser.add_argument("--save_folder_name", type=str, default="None",
                         help="If not set, current date will be used for saved files' folder name.")
+    parser.add_argument("--log_verbosity", type=str, default="full",
+                        choices=["full", "brief", "none"],
+                        help="How agent responses are logged: in full, truncated, or not at all.")
+    parser.add_argument("--log_max_mb", type=float, default=100,
+                        help="Size in MB at which the log file is rotated (0 never rotates).")
+    parser.add_argument("--log_backup_count", type=int, default=5,
+                        help="Number of rotated log files to keep.")
+    parser.add_argument("--metrics_path", type=str, default=None,
+                        help="If set, per-call latency, retries and token usage are written to this jsonl file.")
+    parser.add_argument("--metrics_interval", type=float, default=30,
+                        help="Seconds between two flushes of the call metrics.")
+    parser.add_argument("--trace_path", type=str, default=None,
+                        help="If set, spans of samples, turns, rounds and agent calls are written to this chrome trace file (open with Perfetto).")
+    parser.add_argument("--status_port", type=int, default=None,
+                        help="If set, the live job status (progress, throughput, eta, retries, tokens) is served as json at http://127.0.0.1:<port>/status.")
+    parser.add_argument("--status_file", type=str, default=None,
+                        help="If set, the live job status is rewritten to this json file every --status_interval seconds.")
+    parser.add_argument("--status_interval", type=float, default=10,
+                        help="Seconds between two rewrites of --status_file.")
+    parser.add_argument("--result_sink", type=str, default="file",
+                        choices=["file", "jsonl"],
+                        help="How edit results are saved: one json file per sample, or rolling jsonl shards indexed by res/<save_folder_name>/_manifest.jsonl.")
+    parser.add_argument("--shard_max_records", type=int, default=10000,
+                        help="Max number of samples in one result shard (--result_sink jsonl).")
+    parser.add_argument("--shard_max_mb", type=float, default=256,
+                        help="Max size in MB of one result shard (--result_sink jsonl).")
+    parser.add_argument("--compress_shards", action='store_true',
+                        help="If set, result shards are gzip compressed, record by record (--result_sink jsonl).")
 
     # Arguments for Data Loding
     parser.add_argument("--task_name", type=str, default="edit",
@@ -30,13 +58,15 @@ def parse_args():
                         help="The start indx of loading data.")
     parser.add_argument("--end_indx", type=int, default=None,
                         help="The end indx of loading data.")
+    parser.add_argument("--resume", action='store_true',
+                        help="If set, samples that already have a successful result in res/<save_folder_name> are skipped.")
 
     # Arguments for Model Setting
     parser.add_argument("--model_name", type=str, default="gpt-3.5-turbo",
                         choices=["gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-1106",
                                  "gpt-4", "gpt-4-0613", "gpt-4-1106-preview",
                                  "ernie-bot-4", "ernie-bot-turbo",
-                                 "chatglm_turbo",
+                                 "glm-4", "glm-4-air", "glm-3-turbo",
                                  "mixtral"],
                         help="ID of the model to use")
     parser.add_argument("--use_local_model", action='store_true',
@@ -45,10 +75,36 @@ def parse_args():
                         help="Proxy api url for requesting gpt model.")
     parser.add_argument("--api_keys", type=str, default=None,
                         help="Path of a txt file which contains api keys to communicate with gpt models.")
-    parser.add_argument("--api_key_indx", type=int, default=0,
-                        help="The indx of api key used for request this time within the file.")
+    parser.add_argument("--api_key_indx", type=int, default=None,
+                        help="If set, only the key with this indx within the file is used. Otherwise requests are spread over all keys.")
+    parser.add_argument("--rpm_limit", type=int, default=None,
+                        help="Requests-per-minute budget of each api key. If not set, requests are not rate limited.")
+    parser.add_argument("--tpm_limit", type=int, default=None,
+                        help="Tokens-per-minute budget of each api key (prompt tokens + max_tokens). If not set, tokens are not rate limited.")
     parser.add_argument("--api_base", type=str, default=None,
                         help="If deployed locally, the IP address of the chat model api is required.")
+    parser.add_argument("--pool_size", type=int, default=None,
+                        help="Size of the keep-alive connection pool of each model client. If not set, the most calls the workers can have in flight (--num_workers times the concurrent calls per sample).")
+    parser.add_argument("--keepalive_expiry", type=float, default=30.0,
+                        help="Seconds an idle keep-alive connection is kept open in the client pool.")
+    parser.add_argument("--max_retries", type=int, default=2,
+                        help="Max number of retries of a failed request (only for timeouts, connection errors, 429 and 5xx).")
+    parser.add_argument("--retry_base_delay", type=float, default=1.0,
+                        help="Base delay in seconds of the exponential backoff between retries.")
+    parser.add_argument("--retry_max_delay", type=float, default=60.0,
+                        help="Upper bound in seconds of a single backoff delay (also caps Retry-After).")
+    parser.add_argument("--cache_path", type=str, default=None,
+                        help="Path of a sqlite response cache. If set and --temperature is 0, identical requests are served from the cache.")
+    parser.add_argument("--cache_max_mb", type=float, default=1024,
+                        help="Size budget of the response cache in MB, least recently used responses are evicted beyond it.")
+    parser.add_argument("--batch_generation", action='store_true',
+                        help="If set (with --use_local_model), concurrent agent calls of different samples are sent to the completions endpoint in batches, with chat templates rendered by fastchat.")
+    parser.add_argument("--batch_window_ms", type=float, default=10,
+                        help="How long in ms the first request of a batch waits for more requests (--batch_generation).")
+    parser.add_argument("--max_batch_size", type=int, default=32,
+                        help="Max number of prompts in one batched request (--batch_generation).")
+    parser.add_argument("--chat_template", type=str, default="mistral",
+                        help="Name of the fastchat conversation template of the local model (--batch_generation).")
     parser.add_argument("--max_tokens", type=int, default=1000,
                         help="The maximum number of tokens to generate in the chat completion.")
     parser.add_argument("--completion_number", type=int, default=1,
@@ -62,7 +118,20 @@ def parse_args():
 
     # Arguments for Agent Scheduler
     parser.add_argument("--num_workers", type=int, default=10,
-                        help="Number of multi-threads used for edit.")
+                        help="Number of multi-threads used for edit (number of concurrent samples with --use_async).")
+    parser.add_argument("--use_async", action='store_true',
+                        help="If set, samples are processed as coroutines on a single event loop with native async model clients instead of a thread pool.")
+    parser.add_argument("--sched_mode", type=str, default="sample",
+                        choices=["sample", "stage"],
+                        help="sample: each worker runs whole samples. stage: each agent role of edit mode 4 has its own queue and worker pool, and samples flow through them, with as many samples in flight as stage workers (requires --use_async and --edit_mode 4).")
+    parser.add_argument("--stage_workers", nargs='+', type=str, default=None,
+                        help="Worker pool sizes per stage for --sched_mode stage, e.g. judge=16 advisor=4 (stages: positive_pred, critical_pred, free, advisor, editor, judge). Other stages use --num_workers.")
+    parser.add_argument("--adaptive_concurrency", action='store_true',
+                        help="If set, the number of in-flight requests is tuned by an AIMD controller from observed latency, 429 and 5xx errors.")
+    parser.add_argument("--min_concurrency", type=int, default=1,
+                        help="Lower bound of in-flight requests for --adaptive_concurrency.")
+    parser.add_argument("--max_concurrency", type=int, default=None,
+                        help="Upper bound of in-flight requests for --adaptive_concurrency. If not set, the most calls the workers can have in flight (--num_workers times the concurrent calls per sample).")
     parser.add_argument("--edit_mode", nargs='+', type=str,
                         default=["0", "3"],
                         help="List of mode to get output for instruction data samples.")
@@ -103,7 +172,8 @@ def prepare_for_loading(args):
     # convert reverse indx of loading data
     if args.end_indx is not None:
         assert args.start_indx < args.end_indx, "The start_indx should be smaller than end_indx for data loading!"
-    args.mem_path = get_mem_path(args)
+    # session histories are only written to disk with --save_mem
+    args.mem_path = get_mem_path(args) if args.save_mem else None
     args.res_path = get_res_path(args)
     args.error_path = get_error_path(args)
     args_dict = save_args(args, save_log_path)
@@ -115,7 +185,7 @@ def prepare_for_loading(args):
 
 def load_api_keys(args):
     if args.use_local_model:
-        args.api_keys = "<LOCAL_API_KEY>"
+        args.api_keys = ["<LOCAL_API_KEY>"]
     else:
         assert args.api_keys, "Keys should be set for proprietary model!"
         with open(args.api_keys, 'r') as file:
@@ -132,9 +202,15 @@ def load_api_keys(args):
                 args.api_keys = api_dict["glm"]
             else:
                 raise NotImplementedError
+        # each provider entry may hold a single key or a list of keys
+        if not isinstance(args.api_keys, list):
+            args.api_keys = [args.api_keys]
+        if args.api_key_indx is not None:
+            args.api_keys = [args.api_keys[args.api_key_indx]]
 
 
 def main(args):
+    configure_logging(args)
     prepare_for_loading(args)
     sched = ConCurAgentScheduler(args)
     sched.main_run()
@@ -0,0 +1,239 @@
+from mylogging import my_log
+import contextvars
+import contextlib
+import threading
+import atexit
+import bisect
+import json
+import time
+
+
+# the stats of the model call in progress, set by the agent around model.query
+# so that the retry policy, limiter and models can record into it without
+# passing it through every signature (asyncio.to_thread copies it along)
+current_call = contextvars.ContextVar("current_call", default=None)
+
+# histograms are kept per (role, edit_mode, round), sample ids only go to the call records
+SERIES_TAGS = ["role", "edit_mode", "round"]
+CALL_FIELDS = ["wall_s", "queue_wait_s", "retries", "prompt_tokens", "completion_tokens"]
+
+
+class CallStats():
+    def __init__(self) -> None:
+        self.start_t = time.monotonic()
+        self.wall_s = 0.0
+        self.queue_wait_s = 0.0
+        self.retries = 0
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.usage_source = None
+        self.error = False
+
+    def finish(self) -> None:
+        self.wall_s = time.monotonic() - self.start_t
+
+    def to_dict(self) -> dict:
+        return {
+            "wall_s": self.wall_s,
+            "queue_wait_s": self.queue_wait_s,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "usage_source": self.usage_source,
+            "error": self.error,
+        }
+
+
+@contextlib.contextmanager
+def track_call():
+    # yields the stats of a model call, or None when metrics are disabled
+    if not call_metrics.enabled:
+        yield None
+        return
+    stats = CallStats()
+    token = current_call.set(stats)
+    try:
+        yield stats
+    finally:
+        current_call.reset(token)
+        stats.finish()
+
+
+def record_queue_wait(seconds: float = None) -> None:
+    stats = current_call.get()
+    if stats is not None:
+        stats.queue_wait_s += seconds
+
+
+def record_retry() -> None:
+    stats = current_call.get()
+    if stats is not None:
+        stats.retries += 1
+
+
+def record_usage(usage=None) -> None:
+    # the "usage" field of a response, an openai object or a plain dict
+    stats = current_call.get()
+    if stats is None or not usage:
+        return
+    if isinstance(usage, dict):
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+    else:
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+    if prompt_tokens is None or completion_tokens is None:
+        return
+    stats.prompt_tokens = prompt_tokens
+    stats.completion_tokens = completion_tokens
+    stats.usage_source = "api"
+
+
+class Histogram():
+    # fixed exponential buckets (1ms .. ~5e8), shared by latencies and token counts
+    BOUNDS = [1e-3 * 2 ** i for i in range(40)]
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value: float = None) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float = None) -> float:
+        # upper bound of the bucket holding the quantile
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for indx, num in enumerate(self.counts):
+            seen += num
+            if seen >= rank and num:
+                return min(self.BOUNDS[indx], self.max) if indx < len(self.BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class CallMetrics():
+    # shared by all agents, disabled unless --metrics_path is set or
+    # a listener (e.g. the job status) wants to see the calls
+    def __init__(self) -> None:
+        self.enabled = False
+        self.listeners = []
+        self.path = None
+        self.interval = None
+        self.lock = threading.Lock()
+        self.series = {}
+        self.num_calls = 0
+        self.num_errors = 0
+        self.pending = []
+        # keeps the appended flushes in order, taken without the lock
+        self.write_lock = threading.Lock()
+        self.writer = None
+        self.stop_event = threading.Event()
+
+    def configure(self, path: str = None, interval: float = 30.0) -> None:
+        self.path = path
+        self.interval = interval
+        self.enabled = path is not None or bool(self.listeners)
+        if path is not None:
+            # flushed on a timer, so a stalled job still writes its last calls,
+            # and once more at exit if the job never gets to report
+            self.writer = threading.Thread(target=self.__run_writer, daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+            my_log.info(f"Writing call metrics to {path} every {interval}s")
+
+    def add_listener(self, func=None) -> None:
+        # func(stats, tags) is called after every model call
+        self.listeners.append(func)
+        self.enabled = True
+
+    def observe(self, stats: CallStats = None, tags: dict = None) -> None:
+        key = tuple(tags.get(tag) for tag in SERIES_TAGS)
+        with self.lock:
+            hists = self.series.get(key)
+            if hists is None:
+                hists = self.series[key] = {field: Histogram() for field in CALL_FIELDS}
+            for field in CALL_FIELDS:
+                value = getattr(stats, field)
+                if value is not None:
+                    hists[field].add(value)
+            self.num_calls += 1
+            self.num_errors += stats.error
+            if self.path is not None:
+                self.pending.append(dict(tags, ts=time.time(), **stats.to_dict()))
+        for func in self.listeners:
+            func(stats, tags)
+
+    def __snapshot(self) -> list:
+        # called with the lock held: the calls since the last flush, then
+        # a cumulative snapshot of every histogram
+        records = [dict(record, type="call") for record in self.pending]
+        now = time.time()
+        for key, hists in self.series.items():
+            for field, hist in hists.items():
+                record = dict(zip(SERIES_TAGS, key), type="hist", ts=now, metric=field)
+                record.update(hist.snapshot())
+                records.append(record)
+        self.pending = []
+        return records
+
+    def flush(self) -> None:
+        if self.path is None:
+            return
+        # only the snapshot is taken under the lock, a slow disk never holds up the calls
+        with self.write_lock:
+            with self.lock:
+                records = self.__snapshot()
+            try:
+                with open(self.path, 'a') as f:
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+            except OSError as e:
+                my_log.warning(f"Failed to write metrics to {self.path}: {e}")
+
+    def __run_writer(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+
+    def close(self) -> None:
+        if self.writer is None:
+            return
+        self.stop_event.set()
+        self.writer.join()
+        self.writer = None
+        self.flush()
+
+    def report(self) -> None:
+        if not self.enabled:
+            return
+        self.close()
+        with self.lock:
+            my_log.info(f"Model calls: {self.num_calls}, failed: {self.num_errors}")
+            for key, hists in sorted(self.series.items(), key=lambda item: str(item[0])):
+                wall = hists["wall_s"].snapshot()
+                my_log.info(
+                    f"Calls {dict(zip(SERIES_TAGS, key))}: {wall['count']} calls, "
+                    f"wall mean {wall['mean']:.3f}s p50 {wall['p50']:.3f}s p99 {wall['p99']:.3f}s, "
+                    f"queue wait {hists['queue_wait_s'].snapshot()['mean']:.3f}s, "
+                    f"retries {int(hists['retries'].sum)}, "
+                    f"tokens {int(hists['prompt_tokens'].sum)} prompt / {int(hists['completion_tokens'].sum)} completion"
+                )
+
+
+call_metrics = CallMetrics()
@@ -0,0 +1,229 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import argparse
+import hashlib
+import random
+import time
+import json
+
+
+# A local stand-in for an OpenAI-compatible server (e.g. vllm), used to
+# measure the client and scheduler overhead without a real model behind it.
+# Latencies, injected errors and responses are drawn from a generator seeded by
+# the request body (and its attempt number), so repeated runs see the same server.
+
+
+FILLER_WORDS = ["the", "response", "is", "clear", "and", "helpful", "with", "more", "details", "about", "it"]
+
+
+class MockConfig():
+    def __init__(self,
+                 latency: float = 0.0,
+                 latency_dist: str = "fixed",
+                 tokens_per_sec: float = None,
+                 completion_tokens: int = 32,
+                 error_rate: float = 0.0,
+                 throttle_rate: float = 0.0,
+                 retry_after: float = 1.0,
+                 judge_output: str = "<assistant 2>",
+                 seed: int = 0,
+                 ) -> None:
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.tokens_per_sec = tokens_per_sec
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.judge_output = judge_output
+        self.seed = seed
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def get_rng(self, raw_body: bytes = None) -> random.Random:
+        # a retried request gets the next attempt number, so it is not doomed
+        # to hit the same injected error again
+        body_hash = hashlib.sha256(raw_body).hexdigest()
+        with self.lock:
+            attempt = self.attempts.get(body_hash, 0)
+            self.attempts[body_hash] = attempt + 1
+        return random.Random(f"{self.seed}-{body_hash}-{attempt}")
+
+    def sample_latency(self, rng: random.Random = None, completion_tokens: int = 0) -> float:
+        if self.latency_dist == "exp":
+            latency = rng.expovariate(1 / self.latency) if self.latency else 0.0
+        elif self.latency_dist == "lognormal":
+            # heavy tail around the median latency
+            latency = self.latency * rng.lognormvariate(0, 0.5)
+        elif self.latency_dist == "uniform":
+            latency = rng.uniform(0, 2 * self.latency)
+        else:
+            latency = self.latency
+        if self.tokens_per_sec:
+            latency += completion_tokens / self.tokens_per_sec
+        return latency
+
+    def gen_text(self, prompt: str = None, rng: random.Random = None) -> str:
+        # judge prompts end with a "[System]" block and get a parsable verdict
+        if "[System]" in prompt:
+            head = self.judge_output
+        else:
+            head = "<mock response>"
+        words = [rng.choice(FILLER_WORDS) for _ in range(max(0, self.completion_tokens - 2))]
+        return head + "\n" + " ".join(words)
+
+
+def build_completion(body: dict = None, config: MockConfig = None, rng: random.Random = None) -> dict:
+    messages = body.get("messages", [])
+    content = messages[-1]["content"] if messages else ""
+    resp = config.gen_text(content, rng)
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": resp},
+                "finish_reason": "stop"
+            } for i in range(body.get("n", 1) or 1)
+        ],
+        "usage": {
+            "prompt_tokens": len(content.split()),
+            "completion_tokens": len(resp.split()),
+            "total_tokens": len(content.split()) + len(resp.split())
+        }
+    }
+
+
+def build_text_completion(body: dict = None, config: MockConfig = None, rng: random.Random = None) -> dict:
+    # vllm style batched completions: n choices per prompt, in prompt order
+    prompts = body.get("prompt", "")
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    n = body.get("n", 1) or 1
+    choices = []
+    for prompt in prompts:
+        for _ in range(n):
+            choices.append({
+                "index": len(choices),
+                "text": config.gen_text(prompt, rng),
+                "logprobs": None,
+                "finish_reason": "stop"
+            })
+    prompt_tokens = sum(len(prompt.split()) for prompt in prompts)
+    completion_tokens = sum(len(choice["text"].split()) for choice in choices)
+    return {
+        "id": "cmpl-mock",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # keep-alive, so pooled clients can actually reuse connections
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, avoid delayed-ack stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def __send_json(self, code: int = 200, obj: dict = None, headers: dict = None) -> None:
+        payload = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:
+        config = self.server.config
+        length = int(self.headers.get("Content-Length", 0))
+        raw_body = self.rfile.read(length)
+        body = json.loads(raw_body or b"{}")
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            build_func = build_completion
+        elif path.endswith("/completions"):
+            build_func = build_text_completion
+        else:
+            self.__send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+
+        rng = config.get_rng(raw_body)
+        draw = rng.random()
+        if draw < config.throttle_rate:
+            self.__send_json(429, {"error": {"message": "mock rate limit", "type": "rate_limit_error"}},
+                             headers={"Retry-After": str(config.retry_after)})
+            return
+        if draw < config.throttle_rate + config.error_rate:
+            self.__send_json(500, {"error": {"message": "mock server error", "type": "server_error"}})
+            return
+        completion = build_func(body, config, rng)
+        latency = config.sample_latency(rng, completion["usage"]["completion_tokens"])
+        if latency:
+            time.sleep(latency)
+        self.__send_json(200, completion)
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, **config_kwargs) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.config = MockConfig(latency=latency, **config_kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds to sleep before answering each request (median for lognormal, mean for exp/uniform).")
+    parser.add_argument("--latency_dist", type=str, default="fixed",
+                        choices=["fixed", "uniform", "exp", "lognormal"])
+    parser.add_argument("--tokens_per_sec", type=float, default=None,
+                        help="If set, each response additionally takes completion_tokens / tokens_per_sec seconds.")
+    parser.add_argument("--completion_tokens", type=int, default=32,
+                        help="Number of words in each mock response.")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a 500 error.")
+    parser.add_argument("--throttle_rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a 429 error and a Retry-After header.")
+    parser.add_argument("--retry_after", type=float, default=1.0,
+                        help="Retry-After seconds of the injected 429 errors.")
+    parser.add_argument("--judge_output", type=str, default="<assistant 2>",
+                        help="First line of the answers to judge prompts.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = start_server(
+        args.host,
+        args.port,
+        args.latency,
+        latency_dist=args.latency_dist,
+        tokens_per_sec=args.tokens_per_sec,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        judge_output=args.judge_output,
+        seed=args.seed,
+    )
+    print(f"Mock server listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
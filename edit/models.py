@@ -1,12 +1,65 @@
 from mylogging import my_log
+from retry import ProviderError, get_retry_policy
+from concurrency import get_limiter, get_max_inflight
+from metrics import record_usage
+from cache import get_response_cache, cached_query, acached_query, probe_cache
+from batching import get_batcher, render_chat_prompt, get_stop_kwargs
+from requests.adapters import HTTPAdapter
 import requests
 import zhipuai
-from openai import OpenAI
-import openai
+from openai import OpenAI, AsyncOpenAI
+import threading
+import asyncio
+import httpx
 import time
 import json
 
 
+def get_pool_size(args) -> int:
+    # by default every call the workers can have in flight (concurrent edit
+    # modes, debaters and judge orders of a sample) gets its own connection
+    return args.pool_size if args.pool_size else get_max_inflight(args)
+
+
+class OpenAIClientPool():
+    def __init__(self, args, base_url: str = None) -> None:
+        self.base_url = base_url
+        pool_size = get_pool_size(args)
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=args.keepalive_expiry
+        )
+        self.clients = {}
+        self.async_clients = {}
+        self.lock = threading.Lock()
+
+    def get(self, api_key: str = None) -> OpenAI:
+        # OpenAI clients are thread-safe, so one client (and one connection pool)
+        # per key is shared by all worker threads
+        with self.lock:
+            if api_key not in self.clients:
+                self.clients[api_key] = OpenAI(
+                    api_key=api_key,
+                    base_url=self.base_url,
+                    # retries are handled by the shared RetryPolicy
+                    max_retries=0,
+                    http_client=httpx.Client(limits=self.limits)
+                )
+            return self.clients[api_key]
+
+    def aget(self, api_key: str = None) -> AsyncOpenAI:
+        with self.lock:
+            if api_key not in self.async_clients:
+                self.async_clients[api_key] = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=self.base_url,
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(limits=self.limits)
+                )
+            return self.async_clients[api_key]
+
+
 class GPTModel():
     def __init__(self, args) -> None:
         self.model_name = args.model_name
@@ -14,33 +67,73 @@ class GPTModel():
         self.n = args.completion_number
         self.temp = args.temperature
         self.top_p = args.top_p
+        self.client_pool = OpenAIClientPool(args)
+        self.retry_policy = get_retry_policy(args)
+        self.limiter = get_limiter(args)
+        self.cache = get_response_cache(args)
+
+    def __get_cache_key(self, prompt: list[dict[str, str]] = None) -> str:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            temperature=self.temp,
+            top_p=self.top_p,
+            n=self.n,
+            messages=prompt
+        )
+
+    def probe_cache(self, prompt: list[dict[str, str]] = None) -> str:
+        return probe_cache(self.cache, self.__get_cache_key(prompt))
 
     def query(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
-        error_cnt = 1
-        response = '__error__'
-        cnt = 0
-        while error_cnt == 1 and cnt < 3:
-            try:
-                completion = openai.ChatCompletion.create(
-                    api_key=api_key,
-                    model=self.model_name,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temp,
-                    top_p=self.top_p,
-                    n=self.n,
-                    messages=prompt
-                )
-                error_cnt = 0
-            except Exception as e:
-                my_log.error(f'Error: {e}')
-                time.sleep(3)
-                cnt += 1
-        if cnt == 3:
-            time.sleep(3)
+        return cached_query(self.cache, self.__get_cache_key(prompt),
+                            self.__query_chat_completion, prompt, api_key)
+
+    async def aquery(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        return await acached_query(self.cache, self.__get_cache_key(prompt),
+                                   self.__aquery_chat_completion, prompt, api_key)
+
+    def __query_chat_completion(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        client = self.client_pool.get(api_key)
+        try:
+            completion = self.retry_policy.call(
+                self.limiter.run,
+                client.chat.completions.create,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temp,
+                top_p=self.top_p,
+                n=self.n,
+                messages=prompt
+            )
+            record_usage(completion.usage)
+            response = completion.choices[0].message.content
+        except Exception as e:
+            my_log.error(f'Error: {e}')
+            response = '__error__'
+
+        return response
+
+    async def __aquery_chat_completion(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        client = self.client_pool.aget(api_key)
+        try:
+            completion = await self.retry_policy.acall(
+                self.limiter.arun,
+                client.chat.completions.create,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temp,
+                top_p=self.top_p,
+                n=self.n,
+                messages=prompt
+            )
+            record_usage(completion.usage)
+            response = completion.choices[0].message.content
+        except Exception as e:
+            my_log.error(f'Error: {e}')
             response = '__error__'
-        else:
-            response = completion.choices[0].message['content']
-        time.sleep(3)
 
         return response
 
@@ -54,12 +147,50 @@ class ProxyGPTModel():
         self.n = args.completion_number
         self.temp = args.temperature
         self.top_p = args.top_p
+        self.client_pool = OpenAIClientPool(args, base_url=self.proxy_api_url)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=get_pool_size(args)))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=get_pool_size(args)))
+        self.retry_policy = get_retry_policy(args)
+        self.limiter = get_limiter(args)
+        self.cache = get_response_cache(args)
+
+    def __get_cache_key(self, prompt: list[dict[str, str]] = None) -> str:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            temperature=self.temp,
+            top_p=self.top_p,
+            n=self.n,
+            messages=prompt
+        )
+
+    def probe_cache(self, prompt: list[dict[str, str]] = None) -> str:
+        return probe_cache(self.cache, self.__get_cache_key(prompt))
 
     def query(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
-        response_content=self.__query_chat_completion(prompt, api_key)
+        response_content = cached_query(self.cache, self.__get_cache_key(prompt),
+                                        self.__query_chat_completion, prompt, api_key)
 
         return response_content
 
+    async def aquery(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        response_content = await acached_query(self.cache, self.__get_cache_key(prompt),
+                                               self.__aquery_chat_completion, prompt, api_key)
+
+        return response_content
+
+    def __post_requests(self, headers: dict = None, data: dict = None) -> str:
+        response = self.session.post(
+            self.proxy_api_url, headers=headers, json=data)
+        response.raise_for_status()
+        resp_json = response.json()
+        record_usage(resp_json.get("usage"))
+        return resp_json.get("choices", [{}])[0].get(
+            "message", {}).get("content", "__error__")
+
     def __query_requests(self, prompt: list[dict[str, str]] = None, api_key: str = None)->str:
         headers = {
             'Content-Type': 'application/json',
@@ -74,72 +205,96 @@ class ProxyGPTModel():
             'messages': prompt
         }
 
-        has_error = True
-        retries = 0
-        response_content = "__error__"
-
-        while has_error and retries < 3:
-            try:
-                response = requests.post(
-                    self.proxy_api_url, headers=headers, json=data)
-                response.raise_for_status()
-                response_content = response.json().get("choices", [{}])[0].get(
-                    "message", {}).get("content", "__error__")
-                has_error = False
-            except Exception as e:
-                my_log.error(f"Error: {e}")
-                time.sleep(3)
-                retries += 1
+        try:
+            response_content = self.retry_policy.call(
+                self.limiter.run,
+                self.__post_requests, headers, data)
+        except Exception as e:
+            my_log.error(f"Error: {e}")
+            response_content = "__error__"
         return response_content
     
     def __query_chat_completion(self, prompt: list[dict[str, str]] = None, api_key: str = None)->str:
-        client = OpenAI(
-            api_key=api_key,
-            base_url=self.proxy_api_url,
-        )
-        error_cnt = 1
-        response_content = "__error__"
-        cnt = 0
-        while error_cnt == 1 and cnt < 3:
-            try:
-                completion = client.chat.completions.create(
-                    model=self.model_name,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temp,
-                    top_p=self.top_p,
-                    n=self.n,
-                    messages=prompt
-                )
-                error_cnt = 0
-            except Exception as e:
-                my_log.error(f"Error: {e}")
-                time.sleep(3)
-                cnt += 1
-        if cnt == 3:
-            time.sleep(3)
+        client = self.client_pool.get(api_key)
+        try:
+            completion = self.retry_policy.call(
+                self.limiter.run,
+                client.chat.completions.create,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temp,
+                top_p=self.top_p,
+                n=self.n,
+                messages=prompt
+            )
+            record_usage(completion.usage)
+            response_content = completion.choices[0].message.content
+        except Exception as e:
+            my_log.error(f"Error: {e}")
             response_content = "__error__"
-        else:
+        return response_content
+
+    async def __aquery_chat_completion(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        client = self.client_pool.aget(api_key)
+        try:
+            completion = await self.retry_policy.acall(
+                self.limiter.arun,
+                client.chat.completions.create,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temp,
+                top_p=self.top_p,
+                n=self.n,
+                messages=prompt
+            )
+            record_usage(completion.usage)
             response_content = completion.choices[0].message.content
+        except Exception as e:
+            my_log.error(f"Error: {e}")
+            response_content = "__error__"
         return response_content
 
 
 class ERNIEModel():
+    # error codes returned in the body of a HTTP 200 response:
+    # qps/rpm/tpm limits are throttling, the others are transient server errors
+    THROTTLE_ERROR_CODES = {4, 17, 18, 336501, 336502}
+    SERVER_ERROR_CODES = {2, 336100}
+
     def __init__(self, args) -> None:
         self.model_name = args.model_name
         self.temp = args.temperature
         self.top_p = args.top_p
         self.post_addr = self.__get_post_addr()
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=get_pool_size(args)))
+        self.access_tokens = {}
+        self.token_lock = threading.Lock()
+        self.retry_policy = get_retry_policy(args)
+        self.limiter = get_limiter(args)
+        self.cache = get_response_cache(args)
 
     def __get_access_token(self, api_key: dict = None):
-        url = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}".format_map(
-            api_key)
-        payload = json.dumps("")
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
-        return response.json().get("access_token")
+        # access tokens stay valid for days, only refresh them shortly before expiry
+        client_id = api_key["client_id"]
+        with self.token_lock:
+            cached = self.access_tokens.get(client_id)
+            if cached and cached[1] > time.time():
+                return cached[0]
+            url = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}".format_map(
+                api_key)
+            payload = json.dumps("")
+            headers = {
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            }
+            response = self.session.request("POST", url, headers=headers, data=payload)
+            resp_json = response.json()
+            access_token = resp_json.get("access_token")
+            if access_token:
+                expires_at = time.time() + resp_json.get("expires_in", 0) - 60
+                self.access_tokens[client_id] = (access_token, expires_at)
+            return access_token
 
     def __get_post_addr(self):
         if self.model_name == "ernie-bot-4":
@@ -156,7 +311,43 @@ class ERNIEModel():
         new_prompt = prompt[1:] if sys_content else prompt
         return new_prompt, sys_content
 
+    def __post_chat(self, url: str = None, headers: dict = None, payload: str = None) -> str:
+        response = self.session.request(
+            "POST", url, headers=headers, data=payload)
+        response.raise_for_status()
+        resp_json = json.loads(response.text)
+        if "error_code" in resp_json:
+            error_code = resp_json["error_code"]
+            if error_code in self.THROTTLE_ERROR_CODES:
+                status_code = 429
+            elif error_code in self.SERVER_ERROR_CODES:
+                status_code = 503
+            else:
+                status_code = None
+            raise ProviderError(
+                f"{error_code}: {resp_json.get('error_msg')}", status_code=status_code)
+        record_usage(resp_json.get("usage"))
+        return resp_json.get("result", "__error__")
+
+    def __get_cache_key(self, prompt: list = None, system: str = None) -> str:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(
+            model=self.model_name,
+            temperature=self.temp,
+            top_p=self.top_p,
+            system=system,
+            messages=prompt
+        )
+
+    def probe_cache(self, prompt: list = None, system: str = None) -> str:
+        return probe_cache(self.cache, self.__get_cache_key(prompt, system))
+
     def query(self, prompt: list = None, api_key: dict = None, system: str = None) -> str:
+        return cached_query(self.cache, self.__get_cache_key(prompt, system),
+                            self.__query_chat, prompt, api_key, system)
+
+    def __query_chat(self, prompt: list = None, api_key: dict = None, system: str = None) -> str:
         access_token = self.__get_access_token(api_key)
         url = self.post_addr + f"?access_token={access_token}"
         headers = {
@@ -169,71 +360,91 @@ class ERNIEModel():
             "messages": prompt,
         }
         payload = json.dumps(data)
-        has_error = True
-        sleep_time = 3
-        retries = 0
-        response_content = '__error__'
-
-        while has_error and retries < 3:
-            try:
-                response = requests.request(
-                    "POST", url, headers=headers, data=payload)
-                response.raise_for_status()
-                response_content = json.loads(
-                    response.text).get("result", "__error__")
-                has_error = False
-            except Exception as e:
-                my_log.error(f'Error: {e}')
-                time.sleep(sleep_time)
-                retries += 1
-
-        time.sleep(sleep_time)
+
+        try:
+            response_content = self.retry_policy.call(
+                self.limiter.run,
+                self.__post_chat, url, headers, payload)
+        except Exception as e:
+            my_log.error(f'Error: {e}')
+            response_content = '__error__'
+
         return response_content
 
+    async def aquery(self, prompt: list = None, api_key: dict = None, system: str = None) -> str:
+        # no native async client for ernie, keep the blocking call off the event loop
+        return await asyncio.to_thread(self.query, prompt, api_key, system)
+
 
 class GLMModel():
     def __init__(self, args) -> None:
         self.model_name = args.model_name
         self.temp = args.temperature
         self.top_p = args.top_p
+        self.clients = {}
+        self.client_lock = threading.Lock()
+        self.retry_policy = get_retry_policy(args)
+        self.limiter = get_limiter(args)
+        self.cache = get_response_cache(args)
 
-    def query(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
-        zhipuai.api_key = api_key
-        response = '__error__'
-        error_cnt = 1
-        cnt = 0
-        sleep_time = 3
-
-        while error_cnt == 1 and cnt < 3:
-            try:
-                completion = zhipuai.model_api.invoke(
-                    model=self.model_name,
-                    prompt=prompt,
-                    temperature=self.temp,
-                    top_p=self.top_p
+    def __get_client(self, api_key: str = None):
+        # one client per key: the key must never be process-global state,
+        # calls of different keys run concurrently
+        with self.client_lock:
+            if api_key not in self.clients:
+                self.clients[api_key] = zhipuai.ZhipuAI(
+                    api_key=api_key,
+                    # retries are handled by the shared RetryPolicy
+                    max_retries=0
                 )
-                error_code = completion["code"]
-                error_msg = completion["msg"]
-                assert error_code == 200, error_msg
-                error_cnt = 0
-            except Exception as e:
-                my_log.error(f'Error: {e}')
-                time.sleep(sleep_time)
-                cnt += 1
-
-        if cnt == 3:
-            response = '__error__'
-        else:
-            response = completion["data"]["choices"][0]["content"]
-            try:
-                response = json.loads(response)
-            except Exception as e:
-                time.sleep(sleep_time)
-                return response
-
-        time.sleep(sleep_time)
+            return self.clients[api_key]
+
+    def __invoke(self, prompt: list[dict[str, str]] = None, api_key: str = None):
+        # throttling (codes 1302/1303/1305) comes back as HTTP 429 errors
+        return self.__get_client(api_key).chat.completions.create(
+            model=self.model_name,
+            messages=prompt,
+            temperature=self.temp,
+            top_p=self.top_p
+        )
+
+    def __get_cache_key(self, prompt: list[dict[str, str]] = None) -> str:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(
+            model=self.model_name,
+            temperature=self.temp,
+            top_p=self.top_p,
+            messages=prompt
+        )
+
+    def probe_cache(self, prompt: list[dict[str, str]] = None) -> str:
+        return probe_cache(self.cache, self.__get_cache_key(prompt))
+
+    def query(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        return cached_query(self.cache, self.__get_cache_key(prompt),
+                            self.__query_invoke, prompt, api_key)
+
+    def __query_invoke(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        try:
+            completion = self.retry_policy.call(self.limiter.run, self.__invoke, prompt, api_key)
+        except Exception as e:
+            my_log.error(f'Error: {e}')
+            return '__error__'
+
+        record_usage(completion.usage)
+        response = completion.choices[0].message.content
+        try:
+            response = json.loads(response)
+        except Exception as e:
+            return response
+
         return response
 
+    async def aquery(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        # zhipuai sdk only offers blocking calls, keep them off the event loop
+        return await asyncio.to_thread(self.query, prompt, api_key)
+
     def check_hist(self, hist: list = None) -> list:
         # there is no "system" role in glm model
         # convert and combine system-prompt with the first user-prompt
@@ -270,40 +481,127 @@ class LocalModel():
         self.n = args.completion_number
         self.temp = args.temperature
         self.top_p = args.top_p
+        self.client_pool = OpenAIClientPool(args, base_url=self.proxy_api_url)
+        self.retry_policy = get_retry_policy(args)
+        self.limiter = get_limiter(args)
+        self.cache = get_response_cache(args)
+        self.chat_template = args.chat_template
+        self.batcher = get_batcher(args, self.__query_completion_batch, get_pool_size(args))
+        # every prompt of a job is rendered with the same template
+        self.stop_kwargs = get_stop_kwargs(self.chat_template) if self.batcher else {}
+
+    def __get_cache_key(self, prompt: list[dict[str, str]] = None) -> str:
+        if self.cache is None:
+            return None
+        # a batched completion of the rendered template is a different request
+        # than a chat completion of the same messages
+        return self.cache.make_key(
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            temperature=self.temp,
+            top_p=self.top_p,
+            n=self.n,
+            kind="completion" if self.batcher else "chat",
+            chat_template=self.chat_template if self.batcher else None,
+            stop=self.stop_kwargs,
+            messages=prompt
+        )
+
+    def probe_cache(self, prompt: list[dict[str, str]] = None) -> str:
+        return probe_cache(self.cache, self.__get_cache_key(prompt))
 
     def query(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
-        response_content=self.__query_chat_completion(prompt)
+        query_func = self.__query_batched if self.batcher else self.__query_chat_completion
+        response_content = cached_query(self.cache, self.__get_cache_key(prompt),
+                                        query_func, prompt)
         return response_content
-    
-    def __query_chat_completion(self, prompt: list[dict[str, str]] = None, api_key: str = None)->str:
-        openai_api_key = "EMPTY"
-        openai_api_base = self.proxy_api_url
 
-        client = OpenAI(
-            api_key=openai_api_key,
-            base_url=openai_api_base,
+    async def aquery(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        query_func = self.__aquery_batched if self.batcher else self.__aquery_chat_completion
+        response_content = await acached_query(self.cache, self.__get_cache_key(prompt),
+                                               query_func, prompt)
+        return response_content
+
+    def __query_completion_batch(self, prompts: list[str] = None) -> list[str]:
+        # one completions request for prompts of many samples, vllm returns
+        # n choices per prompt in prompt order
+        client = self.client_pool.get("EMPTY")
+        completion = self.retry_policy.call(
+            self.limiter.run,
+            client.completions.create,
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            temperature=self.temp,
+            top_p=self.top_p,
+            n=self.n,
+            prompt=prompts,
+            **self.stop_kwargs
         )
-        error_cnt = 1
-        response_content = "__error__"
-        cnt = 0
-        while error_cnt == 1 and cnt < 3:
-            try:
-                completion = client.chat.completions.create(
-                    model=self.model_name,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temp,
-                    top_p=self.top_p,
-                    n=self.n,
-                    messages=prompt
-                )
-                error_cnt = 0
-            except Exception as e:
-                my_log.error(f"Error: {e}")
-                time.sleep(3)
-                cnt += 1
-        if cnt == 3:
-            time.sleep(3)
+        responses = [None] * len(prompts)
+        for choice in completion.choices:
+            indx = choice.index // self.n
+            if responses[indx] is None:
+                responses[indx] = choice.text
+        # prompts the server returned no choice for fail like a failed request
+        num_missing = responses.count(None)
+        if num_missing:
+            my_log.error(f"Error: no choice for {num_missing} of {len(prompts)} batched prompts")
+        return [resp if resp is not None else "__error__" for resp in responses]
+
+    def __query_batched(self, prompt: list[dict[str, str]] = None) -> str:
+        try:
+            fut = self.batcher.submit(render_chat_prompt(prompt, self.chat_template))
+            response_content = fut.result()
+        except Exception as e:
+            my_log.error(f"Error: {e}")
             response_content = "__error__"
-        else:
+        return response_content
+
+    async def __aquery_batched(self, prompt: list[dict[str, str]] = None) -> str:
+        try:
+            fut = self.batcher.submit(render_chat_prompt(prompt, self.chat_template))
+            response_content = await asyncio.wrap_future(fut)
+        except Exception as e:
+            my_log.error(f"Error: {e}")
+            response_content = "__error__"
+        return response_content
+    
+    def __query_chat_completion(self, prompt: list[dict[str, str]] = None, api_key: str = None)->str:
+        client = self.client_pool.get("EMPTY")
+        try:
+            completion = self.retry_policy.call(
+                self.limiter.run,
+                client.chat.completions.create,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temp,
+                top_p=self.top_p,
+                n=self.n,
+                messages=prompt
+            )
+            record_usage(completion.usage)
             response_content = completion.choices[0].message.content
+        except Exception as e:
+            my_log.error(f"Error: {e}")
+            response_content = "__error__"
+        return response_content
+
+    async def __aquery_chat_completion(self, prompt: list[dict[str, str]] = None, api_key: str = None) -> str:
+        client = self.client_pool.aget("EMPTY")
+        try:
+            completion = await self.retry_policy.acall(
+                self.limiter.arun,
+                client.chat.completions.create,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temp,
+                top_p=self.top_p,
+                n=self.n,
+                messages=prompt
+            )
+            record_usage(completion.usage)
+            response_content = completion.choices[0].message.content
+        except Exception as e:
+            my_log.error(f"Error: {e}")
+            response_content = "__error__"
         return response_content
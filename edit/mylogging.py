@@ -1,8 +1,47 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import logging
+import atexit
+import queue
 import time
 import os
 
 
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# how agent responses are logged, see configure and log_resp
+LOG_VERBOSITIES = ["full", "brief", "none"]
+BRIEF_RESP_CHARS = 200
+
+
+def get_file_handler(logfile: str = None, max_bytes: int = 0, backup_count: int = 0) -> RotatingFileHandler:
+    # max_bytes=0 never rotates, like the plain FileHandler
+    file_handler = RotatingFileHandler(
+        logfile, maxBytes=max_bytes, backupCount=backup_count, encoding='UTF-8')
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return file_handler
+
+
+class InProcessQueueHandler(QueueHandler):
+    # the stock prepare formats and copies every record in the calling thread,
+    # the queue never leaves the process, so only the args are merged here
+    # (they may be mutated after the call) and the listener does the formatting
+    def prepare(self, record: logging.LogRecord = None) -> logging.LogRecord:
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def get_queue_handler(handlers: list = None) -> tuple[QueueHandler, QueueListener]:
+    # callers only enqueue the record, a single listener thread does the
+    # formatting and disk writes, so workers never wait on the handler locks
+    log_queue = queue.SimpleQueue()
+    queue_handler = InProcessQueueHandler(log_queue)
+    queue_handler.setLevel(logging.INFO)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    return queue_handler, listener
+
+
 def get_logger():
     rq = time.strftime('%Y%m%d%H%M', time.localtime(time.time()))
     log_date = rq[:8]
@@ -14,21 +53,39 @@ def get_logger():
 
     logger = logging.getLogger()
     logger.setLevel(level=logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    file_handler = logging.FileHandler(logfile, encoding='UTF-8')
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(formatter)
+    file_handler = get_file_handler(logfile)
     console_handler = logging.StreamHandler()
     # console_handler.setLevel(logging.DEBUG)
     console_handler.setLevel(logging.ERROR)
-    console_handler.setFormatter(formatter)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    queue_handler, listener = get_queue_handler([file_handler, console_handler])
+    logger.addHandler(queue_handler)
+    listener.start()
+    # drain the queue before the interpreter exits
+    atexit.register(listener.stop)
+
+    return logger, logfile, file_handler
+
+
+my_log, save_log_path, log_file_handler = get_logger()
+log_verbosity = "full"
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
 
-    return logger, logfile
+def configure(args) -> None:
+    global log_verbosity
+    log_verbosity = args.log_verbosity
+    log_file_handler.maxBytes = int(args.log_max_mb * 2**20) if args.log_max_mb else 0
+    log_file_handler.backupCount = args.log_backup_count
 
 
-my_log, save_log_path = get_logger()
+def log_resp(resp: str = None) -> None:
+    # agent responses make up most of the log volume
+    if log_verbosity == "full":
+        my_log.info(resp)
+    elif log_verbosity == "brief":
+        if len(resp) > BRIEF_RESP_CHARS:
+            my_log.info(f"{resp[:BRIEF_RESP_CHARS]}... ({len(resp)} chars)")
+        else:
+            my_log.info(resp)
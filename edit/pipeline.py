@@ -0,0 +1,103 @@
+from mylogging import my_log
+from collections import deque
+import contextvars
+import statistics
+import asyncio
+import time
+
+
+# stages of one round of the iterative pipeline (edit mode 4), in order
+STAGES = ["positive_pred", "critical_pred", "free", "advisor", "editor", "judge"]
+
+
+class Stage():
+    # a queue of agent calls of one role, consumed by its own pool of workers
+    def __init__(self, name: str = None, num_workers: int = None, window: int = 10000) -> None:
+        self.name = name
+        self.num_workers = num_workers
+        self.queue = asyncio.Queue()
+        self.workers = []
+        self.num_jobs = 0
+        self.wait_times = deque(maxlen=window)
+        self.run_times = deque(maxlen=window)
+
+    def start(self) -> None:
+        self.workers = [asyncio.create_task(self.__work()) for _ in range(self.num_workers)]
+
+    async def stop(self) -> None:
+        for _ in self.workers:
+            await self.queue.put(None)
+        await asyncio.gather(*self.workers)
+
+    async def submit(self, job=None):
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, fut, time.monotonic(), contextvars.copy_context()))
+        return await fut
+
+    async def __work(self) -> None:
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                break
+            job, fut, enqueue_t, ctx = item
+            start_t = time.monotonic()
+            try:
+                # run in the context of the submitting sample, so that its
+                # trace spans nest under the sample's own
+                result = await ctx.run(asyncio.ensure_future, job())
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
+            self.num_jobs += 1
+            self.wait_times.append(start_t - enqueue_t)
+            self.run_times.append(time.monotonic() - start_t)
+
+    def stats(self) -> dict:
+        run_times = sorted(self.run_times)
+        return {
+            "workers": self.num_workers,
+            "jobs": self.num_jobs,
+            "wait_mean_s": statistics.mean(self.wait_times) if self.wait_times else 0.0,
+            "run_mean_s": statistics.mean(run_times) if run_times else 0.0,
+            "run_p50_s": run_times[len(run_times) // 2] if run_times else 0.0,
+            "run_p99_s": run_times[max(0, int(len(run_times) * 0.99) - 1)] if run_times else 0.0,
+        }
+
+
+class StagePipeline():
+    # samples flow through the stages instead of one worker running a whole sample,
+    # so the requests in flight are grouped by role (and share its system prompt)
+    def __init__(self, stage_workers: dict = None) -> None:
+        self.stages = {name: Stage(name, stage_workers[name]) for name in STAGES}
+
+    def start(self) -> None:
+        for stage in self.stages.values():
+            stage.start()
+
+    async def stop(self) -> None:
+        await asyncio.gather(*[stage.stop() for stage in self.stages.values()])
+
+    async def submit(self, stage: str = None, job=None):
+        return await self.stages[stage].submit(job)
+
+    def report(self) -> None:
+        for name, stage in self.stages.items():
+            stats = stage.stats()
+            my_log.info(
+                f"Stage {name}: {stats['workers']} workers, {stats['jobs']} jobs, "
+                f"wait {stats['wait_mean_s']:.3f}s, run mean {stats['run_mean_s']:.3f}s "
+                f"p50 {stats['run_p50_s']:.3f}s p99 {stats['run_p99_s']:.3f}s"
+            )
+
+
+def get_stage_workers(args) -> dict:
+    # "--stage_workers judge=16 advisor=4", other stages get --num_workers
+    stage_workers = {name: args.num_workers for name in STAGES}
+    for item in args.stage_workers or []:
+        name, num = item.split("=")
+        assert name in stage_workers, f"Unknown stage {name}, choose from {STAGES}"
+        stage_workers[name] = int(num)
+    return stage_workers
@@ -0,0 +1,143 @@
+import contextlib
+import threading
+import asyncio
+import time
+
+
+class TokenBucket():
+    def __init__(self, limit_per_min: float = None) -> None:
+        # a full minute of budget may be spent at once, then it refills continuously
+        self.capacity = float(limit_per_min)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.last_t = time.monotonic()
+
+    def __refill(self, now: float = None) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_t) * self.rate)
+        self.last_t = now
+
+    def wait_time(self, amount: float = 1, now: float = None) -> float:
+        self.__refill(now)
+        # a request larger than the whole budget only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float = 1) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def fill_ratio(self) -> float:
+        return self.tokens / self.capacity
+
+
+class KeyState():
+    def __init__(self, key=None, rpm_limit: int = None, tpm_limit: int = None) -> None:
+        self.key = key
+        self.rpm_bucket = TokenBucket(rpm_limit) if rpm_limit else None
+        self.tpm_bucket = TokenBucket(tpm_limit) if tpm_limit else None
+        self.in_flight = 0
+        self.num_requests = 0
+        self.num_tokens = 0
+
+    def wait_time(self, num_tokens: int = 0, now: float = None) -> float:
+        wait = 0.0
+        if self.rpm_bucket:
+            wait = max(wait, self.rpm_bucket.wait_time(1, now))
+        if self.tpm_bucket:
+            wait = max(wait, self.tpm_bucket.wait_time(num_tokens, now))
+        return wait
+
+    def load(self) -> tuple:
+        # fewer requests in flight first, then the key with the most budget left
+        budget = min(
+            self.rpm_bucket.fill_ratio() if self.rpm_bucket else 1.0,
+            self.tpm_bucket.fill_ratio() if self.tpm_bucket else 1.0
+        )
+        return (self.in_flight, -budget)
+
+    def consume(self, num_tokens: int = 0) -> None:
+        if self.rpm_bucket:
+            self.rpm_bucket.consume(1)
+        if self.tpm_bucket:
+            self.tpm_bucket.consume(num_tokens)
+        self.in_flight += 1
+        self.num_requests += 1
+        self.num_tokens += num_tokens
+
+
+class KeyPool():
+    def __init__(self, keys: list = None, rpm_limit: int = None, tpm_limit: int = None) -> None:
+        assert keys, "At least one api key is required!"
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.states = [KeyState(key, rpm_limit, tpm_limit) for key in keys]
+        self.lock = threading.Lock()
+
+    @property
+    def is_limited(self) -> bool:
+        return bool(self.rpm_limit or self.tpm_limit)
+
+    def __try_acquire(self, num_tokens: int = 0) -> tuple[KeyState, float]:
+        # dispatch to the least-loaded key that can serve the request right now,
+        # otherwise report how long until the earliest key has budget again
+        with self.lock:
+            now = time.monotonic()
+            ready = []
+            min_wait = None
+            for state in self.states:
+                wait = state.wait_time(num_tokens, now)
+                if wait == 0:
+                    ready.append(state)
+                elif min_wait is None or wait < min_wait:
+                    min_wait = wait
+            if ready:
+                state = min(ready, key=lambda s: s.load())
+                state.consume(num_tokens)
+                return state, 0.0
+            return None, min_wait
+
+    def acquire(self, num_tokens: int = 0) -> KeyState:
+        while True:
+            state, wait = self.__try_acquire(num_tokens)
+            if state is not None:
+                return state
+            time.sleep(wait)
+
+    async def aacquire(self, num_tokens: int = 0) -> KeyState:
+        while True:
+            state, wait = self.__try_acquire(num_tokens)
+            if state is not None:
+                return state
+            await asyncio.sleep(wait)
+
+    def release(self, state: KeyState = None) -> None:
+        with self.lock:
+            state.in_flight -= 1
+
+    @contextlib.contextmanager
+    def lease(self, num_tokens: int = 0):
+        state = self.acquire(num_tokens)
+        try:
+            yield state.key
+        finally:
+            self.release(state)
+
+    @contextlib.asynccontextmanager
+    async def alease(self, num_tokens: int = 0):
+        state = await self.aacquire(num_tokens)
+        try:
+            yield state.key
+        finally:
+            self.release(state)
+
+    def summary(self) -> list[dict]:
+        with self.lock:
+            return [
+                {
+                    "key_indx": indx,
+                    "num_requests": state.num_requests,
+                    "num_tokens": state.num_tokens,
+                } for indx, state in enumerate(self.states)
+            ]
+
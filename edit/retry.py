@@ -0,0 +1,129 @@
+from metrics import record_retry
+from mylogging import my_log
+from email.utils import parsedate_to_datetime
+import requests
+import asyncio
+import openai
+import random
+import httpx
+import time
+
+
+# status codes worth another attempt: timeouts, conflicts, throttling and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ProviderError(Exception):
+    """An error reported in the body of a provider response (e.g. ERNIE/GLM error codes)."""
+
+    def __init__(self, message: str = None, status_code: int = None, retry_after: float = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def get_status_code(e: Exception = None) -> int:
+    status_code = getattr(e, "status_code", None)
+    if status_code is None:
+        response = getattr(e, "response", None)
+        status_code = getattr(response, "status_code", None)
+    return status_code
+
+
+def get_retry_after(e: Exception = None) -> float:
+    retry_after = getattr(e, "retry_after", None)
+    if retry_after is not None:
+        return float(retry_after)
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers.get("retry-after-ms")) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def is_retryable(e: Exception = None) -> bool:
+    status_code = get_status_code(e)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    # failures without any response: dropped connections and timeouts
+    return isinstance(e, (
+        TimeoutError,
+        ConnectionError,
+        openai.APIConnectionError,
+        httpx.TransportError,
+        requests.ConnectionError,
+        requests.Timeout,
+    ))
+
+
+class RetryPolicy():
+    def __init__(self,
+                 max_retries: int = 2,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 jitter: bool = True,
+                 ) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def get_delay(self, attempt: int = 0, e: Exception = None) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        if self.jitter:
+            # full jitter, so throttled workers do not retry in lockstep
+            delay = random.uniform(0, delay)
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def __should_retry(self, attempt: int = 0, e: Exception = None) -> bool:
+        return attempt < self.max_retries and is_retryable(e)
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not self.__should_retry(attempt, e):
+                    raise
+                delay = self.get_delay(attempt, e)
+                attempt += 1
+                record_retry()
+                my_log.warning(f"Retry {attempt}/{self.max_retries} in {delay:.2f}s after error: {e}")
+                time.sleep(delay)
+
+    async def acall(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if not self.__should_retry(attempt, e):
+                    raise
+                delay = self.get_delay(attempt, e)
+                attempt += 1
+                record_retry()
+                my_log.warning(f"Retry {attempt}/{self.max_retries} in {delay:.2f}s after error: {e}")
+                await asyncio.sleep(delay)
+
+
+def get_retry_policy(args) -> RetryPolicy:
+    return RetryPolicy(
+        max_retries=args.max_retries,
+        base_delay=args.retry_base_delay,
+        max_delay=args.retry_max_delay,
+    )
@@ -1,20 +1,27 @@
-from tqdm.asyncio import tqdm_asyncio
+from tqdm import tqdm
 import concurrent.futures
 import functools
 import asyncio
 import time
-import json
 import copy
-import os
 
 from models import GPTModel, ProxyGPTModel, ERNIEModel, GLMModel, LocalModel
 from dataloader import SFTDataLoader
-from agents import LLMAgent
-from utils import check_conv_max_len
+from ratelimit import KeyPool
+from agents import LLMAgent, truncation_stats
+from metrics import call_metrics
+from tracing import tracer
+from status import get_job_status
+from session import SessionTrace
+from sink import get_result_sink
+from concurrency import get_max_inflight
+from pipeline import StagePipeline, get_stage_workers
+from utils import check_conv_max_len, ConvLengthTracker
+from utils import load_completed_ids
 from utils import single_sample2query, multi_sample2query
 from utils import get_sample_prompt, get_task_prompt
 from utils import parse_jdg, merge_jdg_res
-from mylogging import my_log
+from mylogging import my_log, log_resp
 
 
 class ConCurAgentScheduler():
@@ -24,15 +31,33 @@ class ConCurAgentScheduler():
         self.task_name = args.task_name
         self.save_log =args.save_log
         self.save_mem =args.save_mem
-        if isinstance(args.api_keys, list):
-            self.api_key = args.api_keys[args.api_key_indx]
-        else:
-            self.api_key = args.api_keys
+        self.key_pool = KeyPool(
+            args.api_keys,
+            rpm_limit=args.rpm_limit,
+            tpm_limit=args.tpm_limit
+        )
 
         self.mem_pref = args.mem_path
         self.res_pref = args.res_path
         self.error_pref = args.error_path
+        self.result_sink = get_result_sink(args, self.res_pref)
+        if args.resume:
+            self.completed_ids = load_completed_ids(self.res_pref)
+            my_log.info(f"Resume: {len(self.completed_ids)} samples already completed")
+        else:
+            self.completed_ids = set()
         self.num_workers = args.num_workers
+        self.use_async = args.use_async
+        self.sched_mode = args.sched_mode
+        assert self.sched_mode != "stage" or self.use_async, "--sched_mode stage requires --use_async!"
+        # only the iterative pipeline of edit mode 4 runs through the stages
+        assert self.sched_mode != "stage" or "4" in args.edit_mode, "--sched_mode stage requires --edit_mode 4!"
+        self.stage_workers = get_stage_workers(args)
+        self.pipeline = None
+        call_metrics.configure(args.metrics_path, args.metrics_interval)
+        tracer.configure(args.trace_path)
+        self.status, self.status_reporter = get_job_status(
+            args, max(0, self.data.end_indx - self.data.indx), self.__get_gauges)
 
         self.agent_wind_size = args.agent_wind_size
         self.max_agent_len = args.max_agent_len
@@ -45,7 +70,7 @@ class ConCurAgentScheduler():
         self.max_optimize_turn = args.max_optimize_turn
         self.max_optimize_len = args.max_optimize_len
         self.__init_model(args)
-        self.__init_excutor()
+        self.__init_excutor(args)
 
     def __init_model(self, args):
         if args.use_local_model:
@@ -62,63 +87,114 @@ class ConCurAgentScheduler():
         else:
             raise NotImplementedError
 
-    def __init_excutor(self):
-        self.excutor = concurrent.futures.ThreadPoolExecutor(
-            max_workers=self.num_workers)
-
-    def __return_agents(self, key):
+    def __init_excutor(self, args):
+        if self.use_async:
+            # all samples share the event loop, no worker threads needed
+            self.excutor = None
+            self.call_excutor = None
+        else:
+            self.excutor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.num_workers)
+            # the blocking model calls of all samples, one thread per call
+            # the workers can have in flight, see LLMAgent.aact
+            self.call_excutor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=get_max_inflight(args), thread_name_prefix="call")
+
+    def __return_agents(self, key_pool):
         pos_agent = LLMAgent(
             self.model,
             agent_role='positive',
             agent_names=self.agent_names,
-            api_key=key,
+            key_pool=key_pool,
             agent_wind_size=self.agent_wind_size,
             max_agent_len=self.max_agent_len,
+            use_async=self.use_async,
+            call_excutor=self.call_excutor,
         )
         crt_agent = LLMAgent(
             self.model,
             agent_role='critical',
             agent_names=self.agent_names,
-            api_key=key,
+            key_pool=key_pool,
             agent_wind_size=self.agent_wind_size,
             max_agent_len=self.max_agent_len,
+            use_async=self.use_async,
+            call_excutor=self.call_excutor,
         )
         adv_agent = LLMAgent(
             self.model,
             agent_role='advisor',
             agent_names=self.agent_names,
-            api_key=key,
+            key_pool=key_pool,
             agent_wind_size=self.agent_wind_size,
             max_agent_len=self.max_agent_len,
+            use_async=self.use_async,
+            call_excutor=self.call_excutor,
         )
         edt_agent = LLMAgent(
             self.model,
             agent_role='editor',
             agent_names=self.agent_names,
-            api_key=key,
+            key_pool=key_pool,
             agent_wind_size=self.agent_wind_size,
             max_agent_len=self.max_agent_len,
+            use_async=self.use_async,
+            call_excutor=self.call_excutor,
         )
         jdg_agent = LLMAgent(
             self.model,
             agent_role='judge',
             agent_names=self.agent_names,
-            api_key=key,
+            key_pool=key_pool,
             agent_wind_size=self.agent_wind_size,
             max_agent_len=self.max_agent_len,
+            use_async=self.use_async,
+            call_excutor=self.call_excutor,
         )
 
         return pos_agent, crt_agent, adv_agent, edt_agent, jdg_agent
 
+    def __get_gauges(self) -> dict:
+        # read from the status thread without locks, good enough for monitoring
+        gauges = {
+            "num_workers": self.num_workers,
+            # requests holding an api key, including those waiting on the limiter
+            "requests_leased": sum(state.in_flight for state in self.key_pool.states),
+        }
+        limiter = getattr(self.model, "limiter", None)
+        if limiter is not None and limiter.limit is not None:
+            gauges["concurrency_limit"] = int(limiter.limit)
+        if self.pipeline is not None:
+            gauges["stages"] = {
+                name: {"workers": stage.num_workers, "queued": stage.queue.qsize()}
+                for name, stage in self.pipeline.stages.items()
+            }
+        return gauges
+
     def main_run(self):
         start_t = time.time()
+        if self.status_reporter is not None:
+            self.status_reporter.start()
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self.asyn_run())
+        self.result_sink.close()
+        if self.status_reporter is not None:
+            self.status_reporter.stop()
+        tracer.close()
         end_t = time.time()
         print(f"Total time: {end_t-start_t}")
+        if getattr(self.model, "limiter", None) and self.model.limiter.limit is not None:
+            my_log.info(f"Final concurrency limit: {int(self.model.limiter.limit)}")
+        my_log.info(f"Agent memory truncation: {truncation_stats.summary()}")
+        call_metrics.report()
+        if getattr(self.model, "batcher", None):
+            my_log.info(f"Batched generation stats: {self.model.batcher.stats()}")
+        if getattr(self.model, "cache", None):
+            my_log.info(f"Response cache stats: {self.model.cache.stats()}")
+        if self.key_pool.is_limited or len(self.key_pool.states) > 1:
+            my_log.info(f"Api key usage: {self.key_pool.summary()}")
 
     async def asyn_run(self):
-        data_iter = iter(self.data)
         loop = asyncio.get_event_loop()
         if self.task_name == "edit":
             agent_func = self.__return_agents
@@ -126,14 +202,66 @@ class ConCurAgentScheduler():
         else:
             raise NotImplementedError
 
-        tasks = [loop.run_in_executor(self.excutor, functools.partial(
-            run_func, agents=agent_func(self.api_key), sample=sample)) for _, sample in data_iter]
-
-        my_log.info(f"Total number of tasks: {len(tasks)}")
-        await tqdm_asyncio.gather(*tasks)
+        # in stage mode the stage pools bound the requests in flight, admit
+        # enough samples to keep every stage busy at once
+        num_samples = self.num_workers
+        if self.sched_mode == "stage":
+            num_samples = sum(self.stage_workers.values())
+        # bounded window between the lazy data producer and the workers,
+        # so pending samples never grow with the size of the dataset
+        queue = asyncio.Queue(maxsize=num_samples * 2)
+        total_tasks = max(0, self.data.end_indx - self.data.indx)
+        progress = tqdm(total=total_tasks)
+
+        async def produce():
+            for _, sample in self.data:
+                if str(sample["id"]) in self.completed_ids:
+                    progress.update(1)
+                    self.status.skip_sample()
+                    continue
+                await queue.put(sample)
+            for _ in range(num_samples):
+                await queue.put(None)
+
+        async def consume():
+            while True:
+                sample = await queue.get()
+                if sample is None:
+                    break
+                self.status.start_sample()
+                try:
+                    if self.use_async:
+                        with tracer.span("run_edit_proc", "sample", sample_id=sample["id"]):
+                            await run_func(agent_func(self.key_pool), sample)
+                    else:
+                        await loop.run_in_executor(self.excutor, functools.partial(
+                            self.run_in_thread, run_func, agent_func=agent_func, sample=sample,
+                            submit_t=time.monotonic()))
+                except Exception as e:
+                    my_log.error(f"Sample {sample.get('id')} failed: {e}")
+                    self.status.record_result(ok=False)
+                self.status.end_sample()
+                progress.update(1)
+
+        my_log.info(f"Total number of tasks: {total_tasks}")
+        if self.sched_mode == "stage":
+            self.pipeline = StagePipeline(self.stage_workers)
+            self.pipeline.start()
+        await asyncio.gather(produce(), *[consume() for _ in range(num_samples)])
+        if self.pipeline is not None:
+            await self.pipeline.stop()
+            self.pipeline.report()
+        progress.close()
         my_log.info("Task Completed!")
 
-    def run_edit_proc(self, agents, sample):
+    def run_in_thread(self, run_func, agent_func, sample, submit_t: float = None):
+        # agents are created only once a worker thread actually starts the sample;
+        # each executor thread drives its own event loop for one sample at a time
+        with tracer.span("run_edit_proc", "sample", sample_id=sample["id"],
+                         executor_wait_s=time.monotonic() - submit_t):
+            return asyncio.run(run_func(agent_func(self.key_pool), sample))
+
+    async def run_edit_proc(self, agents, sample):
         pos_agent, crt_agent, adv_agent, edt_agent, jdg_agent = agents
         if self.data_format == "alpaca":
             num_turn = 1
@@ -144,11 +272,22 @@ class ConCurAgentScheduler():
         else:
             raise NotImplementedError
 
+        start_t = time.monotonic()
+        # the session history only goes to disk when it should be kept
+        sample_id = sample["id"]
+        for agent in agents:
+            agent.set_tags(sample_id=sample_id)
+        session = SessionTrace(
+            self.mem_pref + f'{sample_id}_hist-session.jsonl' if self.save_mem else None)
+
         if self.data_format=="sharegpt" and num_turn >= 2:
             opt_steps=[]
             updated_sample = copy.deepcopy(sample)
             error_flag = False
             cur_turn = 1
+            # optimized turns are final, so the length of the optimized prefix
+            # only needs the newly added turns to be counted
+            conv_len = ConvLengthTracker()
             
             while True:
                 # print(f"optimizing turn {cur_turn}...")
@@ -158,10 +297,11 @@ class ConCurAgentScheduler():
                         cur_turn=cur_turn,
                         conv_wind_size=self.conv_wind_size
                     )
-                    if "4" in self.edit_mode:
-                        edit_res = self.run_iter_pipeline(agents, query)
-                    else:
-                        edit_res = self.run_sep_pipeline(agents, query)
+                    with tracer.span("optimize_turn", "turn", sample_id=sample_id, turn=cur_turn):
+                        if "4" in self.edit_mode:
+                            edit_res = await self.run_iter_pipeline(agents, query, session)
+                        else:
+                            edit_res = await self.run_sep_pipeline(agents, query, session)
                     opt_steps.append(edit_res)
                 except Exception as e:
                     edit_res={
@@ -197,7 +337,8 @@ class ConCurAgentScheduler():
                         # adaptive optimization length
                         if check_conv_max_len(
                             updated_sample["conversations"][:update_indx+1], 
-                            self.max_optimize_len
+                            self.max_optimize_len,
+                            conv_len
                             ):
                             break
                         else:
@@ -207,7 +348,7 @@ class ConCurAgentScheduler():
                     "optimization_steps": opt_steps,
                     "evol_conversations": updated_sample["conversations"]
                     }
-            self.save_res(total_edit_res, sample)
+            await self.asave_res(total_edit_res, sample, session, time.monotonic() - start_t)
         else:
             try:
                 query = single_sample2query(
@@ -215,38 +356,94 @@ class ConCurAgentScheduler():
                     sample_format=self.data_format
                 )
                 if "4" in self.edit_mode:
-                    edit_res = self.run_iter_pipeline(agents, query)
+                    edit_res = await self.run_iter_pipeline(agents, query, session)
                 else:
-                    edit_res = self.run_sep_pipeline(agents, query)
+                    edit_res = await self.run_sep_pipeline(agents, query, session)
             except Exception as e:
                 edit_res={
                     "edit_error": str(e)
                 }
             finally:
-                self.save_res(edit_res, sample)
-        
-        if not self.save_mem:
-            sample_id = sample["id"]
-            session_name = self.mem_pref + f'{sample_id}_hist-session.json'
-            mem_path = os.getcwd() + '/mems/'
-            tmp_file = os.path.join(mem_path, session_name)
-            os.remove(tmp_file)
-        
+                await self.asave_res(edit_res, sample, session, time.monotonic() - start_t)
+
         del pos_agent
         del crt_agent
         del adv_agent
         del edt_agent
         del jdg_agent
 
-    def run_sep_pipeline(self, agents, cur_query) -> dict:
+    async def __debate(self, agent, agent_role: str = None, ctx_info: dict = None, session: SessionTrace = None) -> str:
+        task_prompt = get_task_prompt(
+            agent_role=agent_role,
+            ctx_info=ctx_info
+        )
+        agent.update_mem(
+            new_mem=task_prompt,
+            role="user"
+        )
+        resp = (await agent.aact(session)).strip()
+        agent.update_mem(
+            new_mem=resp,
+            role="assistant"
+        )
+        log_resp(resp)
+        return resp
+
+    async def __judge(self, agent, ctx_info: dict = None, session: SessionTrace = None, reverse_jdg: bool = False) -> str:
+        task_prompt = get_task_prompt(
+            agent_role="judge",
+            ctx_info=ctx_info,
+            reverse_jdg=reverse_jdg
+        )
+        agent.update_mem(
+            new_mem=task_prompt,
+            role="user"
+        )
+        resp = (await agent.aact(session)).strip()
+        log_resp(resp)
+        return resp
+
+    async def __advise(self, agent, ctx_info: dict = None, session: SessionTrace = None, edt_mode: str = None) -> str:
+        task_prompt = get_task_prompt(
+            agent_role="advisor",
+            ctx_info=ctx_info,
+            edt_mode=edt_mode
+        )
+        agent.update_mem(
+            new_mem=task_prompt,
+            role="user"
+        )
+        resp = (await agent.aact(session)).strip()
+        log_resp(resp)
+        return resp
+
+    async def __edit(self, agent, ctx_info: dict = None, session: SessionTrace = None, edt_mode: str = None) -> str:
+        task_prompt = get_task_prompt(
+            agent_role="editor",
+            ctx_info=ctx_info,
+            edt_mode=edt_mode
+        )
+        agent.update_mem(
+            new_mem=task_prompt,
+            role="user"
+        )
+        resp = (await agent.aact(session)).strip()
+        log_resp(resp)
+        return resp
+
+    async def __stage(self, stage: str = None, job=None, *args, **kwargs):
+        # with --sched_mode stage the call waits for a worker of its stage,
+        # otherwise it runs right away within the sample's own worker
+        if self.pipeline is None:
+            return await job(*args, **kwargs)
+        return await self.pipeline.submit(stage, functools.partial(job, *args, **kwargs))
+
+    async def run_sep_pipeline(self, agents, cur_query, session: SessionTrace = None) -> dict:
         # Edit Mode
         # 0 - editor
         # 1 - advisor (visible: instruction) + editor 
         # 2 - advisor (visible: instruction & response) + editor 
         # 3 - MAD + advisor (visible: instruction & response) + editor 
-        pos_agent, crt_agent, adv_agent, edt_agent, _ = agents
-        sample_id = cur_query["id"]
-        session_name = self.mem_pref + f'{sample_id}_hist-session.json'
         sample_ful, sample_req, have_input = get_sample_prompt(cur_query)
         ctx_info = {
             "sample": sample_ful,
@@ -256,223 +453,69 @@ class ConCurAgentScheduler():
         }
         edit_res = {}
 
-        if "0" in self.edit_mode:
-            edt_task_prompt = get_task_prompt(
-                agent_role="editor",
-                ctx_info=ctx_info,
-                edt_mode="0"
-            )
-            edt_agent.update_mem(
-                new_mem=edt_task_prompt,
-                role="user"
-            )
-            edt_resp = edt_agent.act(session_name).strip()
-            my_log.info(edt_resp)
-            edit_res.update(
-                {
-                    "mode_0": {
-                        "evol_output": edt_resp,
-                    }
-                }
-            )
-
-            edt_agent.clear_mem()
+        # modes only share the read-only sample context: each mode runs
+        # concurrently on its own forked agents and its own copy of ctx_info
+        mode_tasks = []
+        for mode in ["0", "1", "2", "3"]:
+            if mode in self.edit_mode:
+                mode_agents = [agent.fork() for agent in agents]
+                for agent in mode_agents:
+                    agent.set_tags(edit_mode=mode)
+                mode_tasks.append(self.__run_sep_mode(
+                    mode, mode_agents, dict(ctx_info), session))
+        for mode_res in await asyncio.gather(*mode_tasks):
+            edit_res.update(mode_res)
 
-        if "1" in self.edit_mode:
-            # speak of advisor
-            adv_task_prompt = get_task_prompt(
-                agent_role="advisor",
-                ctx_info=ctx_info,
-                edt_mode="1"
-            )
-            adv_agent.update_mem(
-                new_mem=adv_task_prompt,
-                role="user"
-            )
-            adv_resp = adv_agent.act(session_name).strip()
-            my_log.info(adv_resp)
-            ctx_info["adv_sugg"] = adv_resp
-
-            # speak of editor
-            edt_task_prompt = get_task_prompt(
-                agent_role="editor",
-                ctx_info=ctx_info,
-                edt_mode="1"
-            )
-            edt_agent.update_mem(
-                new_mem=edt_task_prompt,
-                role="user"
-            )
-            edt_resp = edt_agent.act(session_name).strip()
-            my_log.info(edt_resp)
-            edit_res.update(
-                {
-                    "mode_1": {
-                        "evol_output": edt_resp,
-                        "suggestions": adv_resp
-                    }
-                }
-            )
+        return edit_res
 
-            adv_agent.clear_mem()
-            edt_agent.clear_mem()
+    async def __run_sep_mode(self, mode: str = None, agents=None, ctx_info: dict = None, session: SessionTrace = None) -> dict:
+        pos_agent, crt_agent, adv_agent, edt_agent, _ = agents
 
-        if "2" in self.edit_mode:
-            # speak of advisor
-            adv_task_prompt = get_task_prompt(
-                agent_role="advisor",
-                ctx_info=ctx_info,
-                edt_mode="2"
-            )
-            adv_agent.update_mem(
-                new_mem=adv_task_prompt,
-                role="user"
-            )
-            adv_resp = adv_agent.act(session_name).strip()
-            my_log.info(adv_resp)
-            ctx_info["adv_sugg"] = adv_resp
-
-            # speak of editor
-            edt_task_prompt = get_task_prompt(
-                agent_role="editor",
-                ctx_info=ctx_info,
-                edt_mode="2"
-            )
-            edt_agent.update_mem(
-                new_mem=edt_task_prompt,
-                role="user"
-            )
-            edt_resp = edt_agent.act(session_name).strip()
-            my_log.info(edt_resp)
-            edit_res.update(
-                {
-                    "mode_2": {
-                        "evol_output": edt_resp,
-                        "suggestions": adv_resp
-                    }
+        if mode == "0":
+            edt_resp = await self.__edit(edt_agent, ctx_info, session, edt_mode="0")
+            return {
+                "mode_0": {
+                    "evol_output": edt_resp,
                 }
-            )
-
-            adv_agent.clear_mem()
-            edt_agent.clear_mem()
+            }
 
-        if "3" in self.edit_mode:
+        if mode == "3":
             # Debate Phase-Round 1: Predetermined Position Debate
-            # speak of positive debater
-            pos_task_prompt = get_task_prompt(
-                agent_role="positive_pred",
-                ctx_info=ctx_info
-            )
-            pos_agent.update_mem(
-                new_mem=pos_task_prompt,
-                role="user"
+            # both debaters only see the sample, so they speak concurrently
+            pos_resp, crt_resp = await asyncio.gather(
+                self.__debate(pos_agent, "positive_pred", ctx_info, session),
+                self.__debate(crt_agent, "critical_pred", ctx_info, session),
             )
-            pos_resp = pos_agent.act(session_name).strip()
-            pos_agent.update_mem(
-                new_mem=pos_resp,
-                role="assistant"
-            )
-            my_log.info(pos_resp)
-
-            # speak of critical debater
-            crt_task_prompt = get_task_prompt(
-                agent_role="critical_pred",
-                ctx_info=ctx_info
-            )
-            crt_agent.update_mem(
-                new_mem=crt_task_prompt,
-                role="user"
-            )
-            crt_resp = crt_agent.act(session_name).strip()
-            crt_agent.update_mem(
-                new_mem=crt_resp,
-                role="assistant"
-            )
-            my_log.info(crt_resp)
-
             ctx_info["pos_pred"] = pos_resp
             ctx_info["crt_pred"] = crt_resp
 
             # Debate Phase-Round 2: Free Debate
-            # speak of positive debater
-            pos_task_prompt = get_task_prompt(
-                agent_role="positive_free",
-                ctx_info=ctx_info
+            # each debater reviews the other's first-round opinion, again concurrently
+            pos_resp, crt_resp = await asyncio.gather(
+                self.__debate(pos_agent, "positive_free", ctx_info, session),
+                self.__debate(crt_agent, "critical_free", ctx_info, session),
             )
-            pos_agent.update_mem(
-                new_mem=pos_task_prompt,
-                role="user"
-            )
-            pos_resp = pos_agent.act(session_name).strip()
-            my_log.info(pos_resp)
-            pos_agent.update_mem(
-                new_mem=pos_resp,
-                role="assistant"
-            )
-
-            # speak of critical debater
-            crt_task_prompt = get_task_prompt(
-                agent_role="critical_free",
-                ctx_info=ctx_info
-            )
-            crt_agent.update_mem(
-                new_mem=crt_task_prompt,
-                role="user"
-            )
-            crt_resp = crt_agent.act(session_name).strip()
-            my_log.info(crt_resp)
-            crt_agent.update_mem(
-                new_mem=crt_resp,
-                role="assistant"
-            )
-
             ctx_info["pos_free"] = pos_resp
             ctx_info["crt_free"] = crt_resp
 
-            # Edit Phase
-            # speak of advisor
-            adv_task_prompt = get_task_prompt(
-                agent_role="advisor",
-                ctx_info=ctx_info,
-                edt_mode="3"
-            )
-            adv_agent.update_mem(
-                new_mem=adv_task_prompt,
-                role="user"
-            )
-            adv_resp = adv_agent.act(session_name).strip()
-            my_log.info(adv_resp)
-            ctx_info["adv_sugg"] = adv_resp
-
-            # speak of editor
-            edt_task_prompt = get_task_prompt(
-                agent_role="editor",
-                ctx_info=ctx_info,
-                edt_mode="3"
-            )
-            edt_agent.update_mem(
-                new_mem=edt_task_prompt,
-                role="user"
-            )
-            edt_resp = edt_agent.act(session_name).strip()
-            my_log.info(edt_resp)
-            edit_res.update(
-                {
-                    "mode_3": {
-                        "evol_output": edt_resp,
-                        "suggestions": adv_resp
-                    }
-                }
-            )
-
-        return edit_res
+        # Edit Phase (modes 1, 2 and 3)
+        # speak of advisor
+        adv_resp = await self.__advise(adv_agent, ctx_info, session, edt_mode=mode)
+        ctx_info["adv_sugg"] = adv_resp
+
+        # speak of editor
+        edt_resp = await self.__edit(edt_agent, ctx_info, session, edt_mode=mode)
+        return {
+            f"mode_{mode}": {
+                "evol_output": edt_resp,
+                "suggestions": adv_resp
+            }
+        }
 
-    def run_iter_pipeline(self, agents, cur_query) -> dict:
+    async def run_iter_pipeline(self, agents, cur_query, session: SessionTrace = None) -> dict:
         # Edit Mode
         # 4 - iterative: MAD + advisor + editor + judge
         pos_agent, crt_agent, adv_agent, edt_agent, jdg_agent = agents
-        sample_id = cur_query["id"]
-        session_name = self.mem_pref + f'{sample_id}_hist-session.json'
         sample_ful, sample_req, have_input = get_sample_prompt(cur_query)
         ctx_info = {
             "sample": sample_ful,
@@ -487,195 +530,111 @@ class ConCurAgentScheduler():
         max_iter = self.max_evol_iter
 
         for cur_round in range(max_iter):
-            # speak of positive debater
-            pos_task_prompt = get_task_prompt(
-                agent_role="positive_pred",
-                ctx_info=ctx_info
-            )
-            pos_agent.update_mem(
-                new_mem=pos_task_prompt,
-                role="user"
-            )
-            pos_resp = pos_agent.act(session_name).strip()
-            pos_agent.update_mem(
-                new_mem=pos_resp,
-                role="assistant"
-            )
-            my_log.info(pos_resp)
-
-            # speak of critical debater
-            crt_task_prompt = get_task_prompt(
-                agent_role="critical_pred",
-                ctx_info=ctx_info
-            )
-            crt_agent.update_mem(
-                new_mem=crt_task_prompt,
-                role="user"
-            )
-            crt_resp = crt_agent.act(session_name).strip()
-            crt_agent.update_mem(
-                new_mem=crt_resp,
-                role="assistant"
-            )
-            my_log.info(crt_resp)
-
-            ctx_info["pos_pred"] = pos_resp
-            ctx_info["crt_pred"] = crt_resp
-
-            # Debate Phase-Round 2: Free Debate
-            # speak of positive debater
-            pos_task_prompt = get_task_prompt(
-                agent_role="positive_free",
-                ctx_info=ctx_info
-            )
-            pos_agent.update_mem(
-                new_mem=pos_task_prompt,
-                role="user"
-            )
-            pos_resp = pos_agent.act(session_name).strip()
-            my_log.info(pos_resp)
-            pos_agent.update_mem(
-                new_mem=pos_resp,
-                role="assistant"
-            )
+            with tracer.span("round", "round", sample_id=pos_agent.tags["sample_id"], round=cur_round):
+                for agent in agents:
+                    agent.set_tags(edit_mode="4", round=cur_round)
+                # every agent call goes through its stage (see --sched_mode)
+                # Debate Phase-Round 1: Predetermined Position Debate
+                # both debaters only see the sample, so they speak concurrently
+                pos_resp, crt_resp = await asyncio.gather(
+                    self.__stage("positive_pred", self.__debate, pos_agent, "positive_pred", ctx_info, session),
+                    self.__stage("critical_pred", self.__debate, crt_agent, "critical_pred", ctx_info, session),
+                )
+                ctx_info["pos_pred"] = pos_resp
+                ctx_info["crt_pred"] = crt_resp
+
+                # Debate Phase-Round 2: Free Debate
+                # each debater reviews the other's first-round opinion, again concurrently
+                pos_resp, crt_resp = await asyncio.gather(
+                    self.__stage("free", self.__debate, pos_agent, "positive_free", ctx_info, session),
+                    self.__stage("free", self.__debate, crt_agent, "critical_free", ctx_info, session),
+                )
+                ctx_info["pos_free"] = pos_resp
+                ctx_info["crt_free"] = crt_resp
 
-            # speak of critical debater
-            crt_task_prompt = get_task_prompt(
-                agent_role="critical_free",
-                ctx_info=ctx_info
-            )
-            crt_agent.update_mem(
-                new_mem=crt_task_prompt,
-                role="user"
-            )
-            crt_resp = crt_agent.act(session_name).strip()
-            my_log.info(crt_resp)
-            crt_agent.update_mem(
-                new_mem=crt_resp,
-                role="assistant"
-            )
+                # Edit Phase
+                # speak of advisor
+                adv_resp = await self.__stage("advisor", self.__advise, adv_agent, ctx_info, session, edt_mode="4")
+                ctx_info["adv_sugg"] = adv_resp
 
-            ctx_info["pos_free"] = pos_resp
-            ctx_info["crt_free"] = crt_resp
+                # speak of editor
+                edt_resp = await self.__stage("editor", self.__edit, edt_agent, ctx_info, session, edt_mode="4")
 
-            # Edit Phase
-            # speak of advisor
-            adv_task_prompt = get_task_prompt(
-                agent_role="advisor",
-                ctx_info=ctx_info,
-                edt_mode="4"
-            )
-            adv_agent.update_mem(
-                new_mem=adv_task_prompt,
-                role="user"
-            )
-            adv_resp = adv_agent.act(session_name).strip()
-            my_log.info(adv_resp)
-            ctx_info["adv_sugg"] = adv_resp
-
-            # speak of editor
-            edt_task_prompt = get_task_prompt(
-                agent_role="editor",
-                ctx_info=ctx_info,
-                edt_mode="4"
-            )
-            edt_agent.update_mem(
-                new_mem=edt_task_prompt,
-                role="user"
-            )
-            edt_resp = edt_agent.act(session_name).strip()
-            my_log.info(edt_resp)
+                ctx_info["new_resp"] = edt_resp
 
-            ctx_info["new_resp"] = edt_resp
+                # speak of judge
+                # the reversed judgement runs on a forked judge with its own memory,
+                # so both orders are judged concurrently
+                jdg_resp1, jdg_resp2 = await asyncio.gather(
+                    self.__stage("judge", self.__judge, jdg_agent, ctx_info, session),
+                    self.__stage("judge", self.__judge, jdg_agent.fork(), ctx_info, session, reverse_jdg=True),
+                )
 
-            # speak of judge
-            jdg_task_prompt = get_task_prompt(
-                agent_role="judge",
-                ctx_info=ctx_info,
-            )
-            jdg_agent.update_mem(
-                new_mem=jdg_task_prompt,
-                role="user"
-            )
-            jdg_resp1 = jdg_agent.act(session_name).strip()
-            my_log.info(jdg_resp1)
-            jdg_agent.clear_mem()
-
-            jdg_task_prompt = get_task_prompt(
-                agent_role="judge",
-                ctx_info=ctx_info,
-                reverse_jdg=True
-            )
-            jdg_agent.update_mem(
-                new_mem=jdg_task_prompt,
-                role="user"
-            )
-            jdg_resp2 = jdg_agent.act(session_name).strip()
-            my_log.info(jdg_resp2)
-
-            # whether to end the iteration
-            jdg_res1 = parse_jdg(jdg_resp1, self.judge_mode)
-            jdg_res2 = parse_jdg(jdg_resp2, self.judge_mode)
-            jdg_sp = merge_jdg_res(jdg_res1, jdg_res2)
-            edit_res.update(
-                {   
-                    f"round_{cur_round}": {
-                        "output": edt_resp,
-                        "suggestions": adv_resp,
-                        "judge": jdg_sp
+                # whether to end the iteration
+                jdg_res1 = parse_jdg(jdg_resp1, self.judge_mode)
+                jdg_res2 = parse_jdg(jdg_resp2, self.judge_mode)
+                jdg_sp = merge_jdg_res(jdg_res1, jdg_res2)
+                edit_res.update(
+                    {   
+                        f"round_{cur_round}": {
+                            "output": edt_resp,
+                            "suggestions": adv_resp,
+                            "judge": jdg_sp
+                        }
                     }
-                }
-            )
-            if -1 not in jdg_sp:
-                if jdg_sp[1] <= jdg_sp[0]:
+                )
+                if -1 not in jdg_sp:
+                    if jdg_sp[1] <= jdg_sp[0]:
+                        edit_res["evol_output"] = ctx_info["pre_resp"]
+                        edit_res["evol_round"] = cur_round
+                        return edit_res
+                    else:
+                        edit_res["evol_output"] = edt_resp
+                        edit_res["evol_round"] = cur_round + 1
+                else:
                     edit_res["evol_output"] = ctx_info["pre_resp"]
                     edit_res["evol_round"] = cur_round
+                    edit_res["evol_error"] = "<JudgeError>"
                     return edit_res
-                else:
-                    edit_res["evol_output"] = edt_resp
-                    edit_res["evol_round"] = cur_round + 1
-            else:
-                edit_res["evol_output"] = ctx_info["pre_resp"]
-                edit_res["evol_round"] = cur_round
-                edit_res["evol_error"] = "<JudgeError>"
-                return edit_res
-
-            next_iter_query = {
-                "instruction": cur_query["instruction"],
-                "input": cur_query["input"],
-                "output": edt_resp
-            }
-            sample_ful, sample_req, have_input = get_sample_prompt(
-                next_iter_query)
-            ctx_info = {
-                "sample": sample_ful,
-                "sample_request": sample_req,
-                "have_input": have_input,
-                "pre_resp": edt_resp
-            }
 
-            pos_agent.clear_mem()
-            crt_agent.clear_mem()
-            adv_agent.clear_mem()
-            edt_agent.clear_mem()
-            jdg_agent.clear_mem()
+                next_iter_query = {
+                    "instruction": cur_query["instruction"],
+                    "input": cur_query["input"],
+                    "output": edt_resp
+                }
+                sample_ful, sample_req, have_input = get_sample_prompt(
+                    next_iter_query)
+                ctx_info = {
+                    "sample": sample_ful,
+                    "sample_request": sample_req,
+                    "have_input": have_input,
+                    "pre_resp": edt_resp
+                }
+
+                pos_agent.clear_mem()
+                crt_agent.clear_mem()
+                adv_agent.clear_mem()
+                edt_agent.clear_mem()
+                jdg_agent.clear_mem()
 
         return edit_res
 
-    def save_res(self, edit_res, ori_sample):
+    def save_res(self, edit_res, ori_sample, session: SessionTrace = None, elapsed: float = None):
         sample_id = ori_sample["id"]
         res_dict = copy.deepcopy(ori_sample)
         res_dict.update(edit_res)
 
         # append memory history to result
-        mem_path = os.getcwd() + '/mems/'
-        session_name = self.mem_pref + f'{sample_id}_hist-session.json'
-        with open(os.path.join(mem_path, session_name), 'r') as f:
-            hist_mem = json.load(f)
-        res_dict["memory_history"] = hist_mem
-
-        res_name = self.res_pref + str(sample_id) + '.json'
-        with open(res_name, 'w') as file:
-            json.dump(res_dict, file)
-        my_log.info(f'Save edit result to {res_name}')
-    
\ No newline at end of file
+        res_dict["memory_history"] = session.read()
+
+        self.result_sink.write(sample_id, res_dict, "error" if "edit_error" in edit_res else "ok", elapsed)
+        self.status.record_result(ok="edit_error" not in edit_res)
+
+    async def asave_res(self, edit_res, ori_sample, session: SessionTrace = None, elapsed: float = None):
+        # with --use_async the copy, serialization and a sink waiting on its
+        # writer would stall every sample on the loop, so they run on a thread;
+        # a thread-mode sample owns its loop and saves in place
+        if self.use_async:
+            await asyncio.to_thread(self.save_res, edit_res, ori_sample, session, elapsed)
+        else:
+            self.save_res(edit_res, ori_sample, session, elapsed)
@@ -0,0 +1,39 @@
+import threading
+import json
+
+
+class SessionTrace():
+    # Trace of every agent action of one sample. The history is kept in memory for
+    # save_res, and with a path it is also appended to disk as JSON Lines (--save_mem),
+    # so each action costs one serialized line instead of re-writing the whole history.
+    def __init__(self, path: str = None, buffer_size: int = 16) -> None:
+        self.path = path
+        self.buffer_size = buffer_size
+        self.entries = []
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def append(self, entry: dict = None) -> None:
+        with self.lock:
+            self.entries.append(entry)
+            if self.path is None:
+                return
+            self.buffer.append(json.dumps(entry))
+            if len(self.buffer) >= self.buffer_size:
+                self.__flush()
+
+    def __flush(self) -> None:
+        if not self.buffer:
+            return
+        with open(self.path, 'a') as f:
+            f.write("\n".join(self.buffer) + "\n")
+        self.buffer = []
+
+    def flush(self) -> None:
+        with self.lock:
+            self.__flush()
+
+    def read(self) -> list[dict]:
+        with self.lock:
+            self.__flush()
+            return list(self.entries)
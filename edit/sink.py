@@ -0,0 +1,236 @@
+from utils import get_manifest_path
+from mylogging import my_log
+import threading
+import queue
+import gzip
+import json
+import os
+
+
+class ResultManifest():
+    # "_manifest.jsonl" in the result folder: one line per saved sample with its status
+    # and location, so it doubles as the id -> shard/offset index of sharded results
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.__terminate()
+
+    def __terminate(self) -> None:
+        # a killed job may leave a torn last line, new entries must start on a fresh one
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def append(self, entries: list[dict] = None) -> None:
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+
+
+class FileResultSink():
+    # one "<rq>_<id>.json" file per sample
+    def __init__(self, res_pref: str = None) -> None:
+        self.res_pref = res_pref
+        self.manifest = ResultManifest(get_manifest_path(res_pref))
+
+    def write(self, sample_id=None, res_dict: dict = None, status: str = None, elapsed: float = None) -> None:
+        res_name = self.res_pref + str(sample_id) + '.json'
+        with open(res_name, 'w') as file:
+            json.dump(res_dict, file)
+        self.manifest.append([{
+            "id": sample_id,
+            "status": status,
+            "file": os.path.basename(res_name),
+            "elapsed": elapsed
+        }])
+        my_log.info(f'Save edit result to {res_name}')
+
+    def close(self) -> None:
+        pass
+
+
+class ShardedResultSink():
+    # results are appended to rolling "<rq>_shard-<n>.jsonl[.gz]" files by a single
+    # writer thread, workers only serialize their sample and enqueue it
+    def __init__(self,
+                 res_pref: str = None,
+                 max_records: int = 10000,
+                 max_bytes: int = None,
+                 compress: bool = False,
+                 max_pending: int = 1024,
+                 ) -> None:
+        self.res_pref = res_pref
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.manifest = ResultManifest(get_manifest_path(res_pref))
+        self.shard_indx = 0
+        self.shard_file = None
+        self.shard_name = None
+        self.shard_records = 0
+        self.error = None
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.writer = threading.Thread(target=self.__run_writer, daemon=True)
+        self.writer.start()
+
+    def write(self, sample_id=None, res_dict: dict = None, status: str = None, elapsed: float = None) -> None:
+        if self.error is not None:
+            raise RuntimeError(f"Result writer failed: {self.error}")
+        record = (json.dumps(res_dict) + "\n").encode("utf-8")
+        if self.compress:
+            # every record is its own gzip member: the shard is still one valid
+            # gzip stream, and a single record can be decompressed from its offset
+            record = gzip.compress(record, compresslevel=6)
+        self.pending.put((sample_id, status, elapsed, record))
+
+    def close(self) -> None:
+        self.pending.put(None)
+        self.writer.join()
+        if self.error is not None:
+            my_log.error(f"Result writer failed: {self.error}")
+
+    def __open_shard(self) -> None:
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        # never append to the shards of an earlier job started in the same minute
+        while True:
+            shard_name = self.res_pref + f"shard-{self.shard_indx:05d}" + suffix
+            self.shard_indx += 1
+            if not os.path.exists(shard_name):
+                break
+        self.shard_file = open(shard_name, 'ab')
+        self.shard_name = shard_name
+        self.shard_records = 0
+
+    def __close_shard(self) -> None:
+        self.shard_file.close()
+        my_log.info(f"Result shard {self.shard_name} closed with {self.shard_records} records")
+        self.shard_file = None
+
+    def __shard_full(self) -> bool:
+        if self.max_records and self.shard_records >= self.max_records:
+            return True
+        return bool(self.max_bytes) and self.shard_file.tell() >= self.max_bytes
+
+    def __write_batch(self, batch: list = None) -> None:
+        entries = []
+        for sample_id, status, elapsed, record in batch:
+            if self.shard_file is None or self.__shard_full():
+                if self.shard_file is not None:
+                    self.__sync_shard(entries)
+                    entries = []
+                    self.__close_shard()
+                self.__open_shard()
+            offset = self.shard_file.tell()
+            self.shard_file.write(record)
+            self.shard_records += 1
+            entries.append({
+                "id": sample_id,
+                "status": status,
+                "file": os.path.basename(self.shard_name),
+                "offset": offset,
+                "length": len(record),
+                "elapsed": elapsed
+            })
+        self.__sync_shard(entries)
+
+    def __sync_shard(self, entries: list = None) -> None:
+        # one fsync per batch, the index only points at records already on disk
+        if not entries:
+            return
+        self.shard_file.flush()
+        os.fsync(self.shard_file.fileno())
+        self.manifest.append(entries)
+        my_log.info(f"Save {len(entries)} edit results to {self.shard_name}")
+
+    def __run_writer(self) -> None:
+        done = False
+        while not done:
+            batch = []
+            item = self.pending.get()
+            while item is not None:
+                batch.append(item)
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+            done = item is None
+            # after a failure keep draining, so that no worker blocks on a full queue
+            if self.error is None:
+                try:
+                    self.__write_batch(batch)
+                except Exception as e:
+                    self.error = e
+                    my_log.error(f"Result writer failed: {e}")
+        if self.shard_file is not None:
+            self.__close_shard()
+
+
+def get_result_sink(args, res_pref: str = None):
+    if args.result_sink == "jsonl":
+        return ShardedResultSink(
+            res_pref,
+            max_records=args.shard_max_records,
+            max_bytes=int(args.shard_max_mb * 2**20) if args.shard_max_mb else None,
+            compress=args.compress_shards
+        )
+    return FileResultSink(res_pref)
+
+
+def list_res_files(res_path: str = None, f_names: list = None) -> list:
+    # resumed jobs may hold several results of one sample ("<rq>_<id>.json"),
+    # keep the latest one and skip the manifest and shards
+    latest = {}
+    if f_names is None:
+        f_names = os.listdir(res_path)
+    for f_name in sorted(f_names):
+        if not f_name.endswith(".json") or "_" not in f_name:
+            continue
+        latest[f_name[f_name.index("_")+1:]] = f_name
+    return list(latest.values())
+
+
+def load_res_index(res_path: str = None) -> dict:
+    # sample id -> location of its latest result, the manifest overrides the
+    # per-sample files of jobs that predate it
+    index = {}
+    f_names = os.listdir(res_path)
+    existing = set(f_names)
+    for f_name in list_res_files(res_path, f_names):
+        index[f_name[f_name.index("_")+1:-5]] = {"file": f_name}
+    manifest_path = os.path.join(res_path, "_manifest.jsonl")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["file"] in existing:
+                    index[str(entry["id"])] = entry
+    return index
+
+
+def read_record(f, entry: dict = None) -> dict:
+    f.seek(entry["offset"])
+    record = f.read(entry["length"])
+    if entry["file"].endswith(".gz"):
+        record = gzip.decompress(record)
+    return json.loads(record)
+
+
+def iter_results(res_path: str = None):
+    # per-sample files are loaded one by one, shards are opened once and
+    # read in offset order
+    shards = {}
+    for entry in load_res_index(res_path).values():
+        if "offset" in entry:
+            shards.setdefault(entry["file"], []).append(entry)
+        else:
+            with open(os.path.join(res_path, entry["file"]), 'r') as f:
+                yield json.load(f)
+    for shard_name, entries in sorted(shards.items()):
+        with open(os.path.join(res_path, shard_name), 'rb') as f:
+            for entry in sorted(entries, key=lambda e: e["offset"]):
+                yield read_record(f, entry)
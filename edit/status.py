@@ -0,0 +1,242 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metrics import call_metrics
+from mylogging import my_log
+from collections import deque
+import threading
+import json
+import time
+import os
+
+
+# sliding windows (seconds) of the reported rates
+STATUS_WINDOWS = [60, 300, 900]
+RATE_FIELDS = ["completed", "failed", "calls", "retries", "prompt_tokens", "completion_tokens"]
+
+
+class RateWindow():
+    # per-second buckets over the longest window, so a snapshot costs the same
+    # whatever the request rate
+    def __init__(self, horizon: int = 900) -> None:
+        self.horizon = horizon
+        self.buckets = deque()
+
+    def add(self, now: float = None, **counts) -> None:
+        sec = int(now)
+        if not self.buckets or self.buckets[-1][0] != sec:
+            self.buckets.append((sec, dict.fromkeys(RATE_FIELDS, 0)))
+            while self.buckets[0][0] <= sec - self.horizon:
+                self.buckets.popleft()
+        bucket = self.buckets[-1][1]
+        for field, num in counts.items():
+            bucket[field] += num
+
+    def rates(self, now: float = None, window: int = None, elapsed: float = None) -> dict:
+        # a window longer than the job so far is averaged over the job's age
+        since = int(now) - window
+        totals = dict.fromkeys(RATE_FIELDS, 0)
+        for sec, bucket in reversed(self.buckets):
+            if sec <= since:
+                break
+            for field in RATE_FIELDS:
+                totals[field] += bucket[field]
+        span = max(1e-3, min(window, elapsed))
+        return {f"{field}/s": num / span for field, num in totals.items()}
+
+
+class JobStatus():
+    def __init__(self,
+                 model_name: str = None,
+                 total: int = 0,
+                 gauges=None,
+                 ) -> None:
+        self.model_name = model_name
+        self.total = total
+        # callable returning the current concurrency figures of the scheduler
+        self.gauges = gauges
+        self.lock = threading.Lock()
+        self.start_t = time.time()
+        self.last_done_t = None
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.window = RateWindow(max(STATUS_WINDOWS))
+        call_metrics.add_listener(self.observe_call)
+
+    def skip_sample(self) -> None:
+        with self.lock:
+            self.skipped += 1
+
+    def start_sample(self) -> None:
+        with self.lock:
+            self.in_flight += 1
+
+    def end_sample(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def record_result(self, ok: bool = True) -> None:
+        now = time.time()
+        with self.lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.last_done_t = now
+            self.window.add(now, completed=int(ok), failed=int(not ok))
+
+    def observe_call(self, stats=None, tags: dict = None) -> None:
+        now = time.time()
+        with self.lock:
+            self.calls += 1
+            self.retries += stats.retries
+            self.prompt_tokens += stats.prompt_tokens or 0
+            self.completion_tokens += stats.completion_tokens or 0
+            self.window.add(now, calls=1, retries=stats.retries,
+                            prompt_tokens=stats.prompt_tokens or 0,
+                            completion_tokens=stats.completion_tokens or 0)
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        elapsed = now - self.start_t
+        with self.lock:
+            rates = {f"{window}s": self.window.rates(now, window, elapsed) for window in STATUS_WINDOWS}
+            done = self.completed + self.failed
+            remaining = max(0, self.total - self.skipped - done)
+            # eta from the shortest window that has seen a finished sample
+            sample_rate = 0.0
+            for window in STATUS_WINDOWS:
+                res = rates[f"{window}s"]
+                sample_rate = res["completed/s"] + res["failed/s"]
+                if sample_rate:
+                    break
+            status = {
+                "time": now,
+                "elapsed_s": elapsed,
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "remaining": remaining,
+                "in_flight": self.in_flight,
+                "eta_s": remaining / sample_rate if sample_rate else None,
+                # a growing age with samples in flight means a stall
+                "last_done_age_s": now - self.last_done_t if self.last_done_t else None,
+                "samples_per_s": {window: {
+                    "completed": res["completed/s"],
+                    "failed": res["failed/s"],
+                } for window, res in rates.items()},
+                "models": {
+                    self.model_name: {
+                        "calls": self.calls,
+                        "retries": self.retries,
+                        "prompt_tokens": self.prompt_tokens,
+                        "completion_tokens": self.completion_tokens,
+                        "rates": {window: {
+                            "calls/s": res["calls/s"],
+                            "retries/s": res["retries/s"],
+                            "retry_ratio": res["retries/s"] / res["calls/s"] if res["calls/s"] else 0.0,
+                            "prompt_tokens/s": res["prompt_tokens/s"],
+                            "completion_tokens/s": res["completion_tokens/s"],
+                        } for window, res in rates.items()},
+                    }
+                },
+            }
+        if self.gauges is not None:
+            status["concurrency"] = self.gauges()
+        return status
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") not in ("", "/status"):
+            self.send_error(404)
+            return
+        payload = json.dumps(self.server.job_status.snapshot(), indent=2).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StatusReporter():
+    # serves the status on 127.0.0.1:<port> and/or rewrites the status file
+    # every interval seconds (written to a temp file, then renamed)
+    def __init__(self,
+                 job_status: JobStatus = None,
+                 port: int = None,
+                 path: str = None,
+                 interval: float = 10.0,
+                 ) -> None:
+        self.job_status = job_status
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.server = None
+        self.writer = None
+        self.stop_event = threading.Event()
+
+    def start(self) -> None:
+        if self.port is not None:
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.port), StatusHandler)
+            self.server.daemon_threads = True
+            self.server.job_status = self.job_status
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            my_log.info(f"Serving job status at http://127.0.0.1:{self.server.server_address[1]}/status")
+        if self.path is not None:
+            self.writer = threading.Thread(target=self.__run_writer, daemon=True)
+            self.writer.start()
+            my_log.info(f"Writing job status to {self.path} every {self.interval}s")
+
+    def write_file(self) -> None:
+        try:
+            with open(self.path + ".tmp", 'w') as f:
+                json.dump(self.job_status.snapshot(), f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            my_log.warning(f"Failed to write job status to {self.path}: {e}")
+
+    def __run_writer(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.write_file()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.writer is not None:
+            self.writer.join()
+            # the final counts stay on disk after the job
+            self.write_file()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class NullStatus():
+    # used when neither --status_port nor --status_file is set
+    def skip_sample(self) -> None:
+        pass
+
+    def start_sample(self) -> None:
+        pass
+
+    def end_sample(self) -> None:
+        pass
+
+    def record_result(self, ok: bool = True) -> None:
+        pass
+
+
+def get_job_status(args, total: int = 0, gauges=None):
+    if args.status_port is None and args.status_file is None:
+        return NullStatus(), None
+    job_status = JobStatus(args.model_name, total, gauges)
+    reporter = StatusReporter(job_status, args.status_port, args.status_file, args.status_interval)
+    return job_status, reporter
@@ -0,0 +1,139 @@
+from mylogging import my_log
+import contextvars
+import contextlib
+import threading
+import heapq
+import json
+import time
+import os
+
+
+# the innermost open span of the running task/thread, parent of the next one
+current_span = contextvars.ContextVar("current_span", default=None)
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Span():
+    def __init__(self, tracer=None, name: str = None, cat: str = None, args: dict = None) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.parent = None
+        self.tid = None
+        self.own_lane = False
+        self.lane_busy = False
+
+    def __enter__(self):
+        self.parent = current_span.get()
+        self.tracer.acquire_lane(self)
+        self.token = current_span.set(self)
+        self.start_t = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        end_t = time.perf_counter()
+        current_span.reset(self.token)
+        self.tracer.release_lane(self)
+        if exc_type is not None:
+            self.args["error"] = repr(exc)
+        self.tracer.emit({
+            "name": self.name,
+            "cat": self.cat,
+            "ph": "X",
+            "ts": (self.start_t - self.tracer.origin_t) * 1e6,
+            "dur": (end_t - self.start_t) * 1e6,
+            "pid": self.tracer.pid,
+            "tid": self.tid,
+            "args": self.args,
+        })
+        return False
+
+
+class Tracer():
+    # spans are written as chrome trace events ("X" complete events), which
+    # Perfetto and chrome://tracing open directly. A span runs on a lane (tid):
+    # the first child of a span stays on its parent's lane, concurrent siblings
+    # get the lowest free lane, so the events of one lane always nest
+    def __init__(self) -> None:
+        self.enabled = False
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_size = 1024
+        self.free_lanes = []
+        self.num_lanes = 0
+        self.pid = os.getpid()
+        self.origin_t = time.perf_counter()
+
+    def configure(self, path: str = None) -> None:
+        self.path = path
+        self.enabled = path is not None
+        if not self.enabled:
+            return
+        # a json array, every event followed by a comma: a trace cut short by a
+        # killed job is still accepted by the viewers
+        self.file = open(path, 'w')
+        self.file.write("[\n")
+        self.emit({"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": "CoEvol"}})
+        my_log.info(f"Writing span trace to {path}")
+
+    def span(self, name: str = None, cat: str = None, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, cat, args)
+
+    def acquire_lane(self, span: Span = None) -> None:
+        with self.lock:
+            parent = span.parent
+            if parent is not None and not parent.lane_busy:
+                parent.lane_busy = True
+                span.tid = parent.tid
+                return
+            if self.free_lanes:
+                span.tid = heapq.heappop(self.free_lanes)
+            else:
+                span.tid = self.num_lanes
+                self.num_lanes += 1
+                self.__emit({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": span.tid,
+                             "args": {"name": f"lane {span.tid}"}})
+            span.own_lane = True
+
+    def release_lane(self, span: Span = None) -> None:
+        with self.lock:
+            if span.own_lane:
+                heapq.heappush(self.free_lanes, span.tid)
+            else:
+                span.parent.lane_busy = False
+
+    def __emit(self, event: dict = None) -> None:
+        # called with the lock held
+        self.buffer.append(json.dumps(event))
+        if len(self.buffer) >= self.buffer_size:
+            self.__flush()
+
+    def __flush(self) -> None:
+        if self.buffer:
+            self.file.write("".join(line + ",\n" for line in self.buffer))
+            self.buffer = []
+
+    def emit(self, event: dict = None) -> None:
+        with self.lock:
+            self.__emit(event)
+
+    def close(self) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.__flush()
+            # the closing event carries no comma, so the array is valid json
+            self.file.write(json.dumps({"name": "trace_end", "ph": "i", "s": "g", "pid": self.pid, "tid": 0,
+                                        "ts": (time.perf_counter() - self.origin_t) * 1e6}) + "\n]\n")
+            self.file.close()
+            self.enabled = False
+        my_log.info(f"Span trace saved to {self.path} ({self.num_lanes} lanes)")
+
+
+tracer = Tracer()
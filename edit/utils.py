@@ -1,17 +1,62 @@
+from mylogging import my_log
+import functools
 import tiktoken
 import json
 import time
 import os
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str = "gpt-3.5-turbo"):
+    # building the encoder is expensive, do it once per process
+    return tiktoken.encoding_for_model(model_name)
+
+
+# rough length of a token in characters, used when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoder():
+    # tiktoken downloads its encoding on first use, which fails on an offline
+    # box (the usual case with a local vllm server): estimate the counts from
+    # the text length rather than failing every agent call
+    try:
+        return get_encoding().encode
+    except Exception as e:
+        my_log.warning(f"Failed to load the tiktoken encoding ({e}), "
+                       f"estimating token counts at {CHARS_PER_TOKEN} characters per token")
+        return None
+
+
 def num_tokens_from_string(string: str=None) -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    num_tokens = len(encoding.encode(string))
+    encode = get_token_encoder()
+    if encode is None:
+        return -(-len(string) // CHARS_PER_TOKEN)
+    num_tokens = len(encode(string))
     return num_tokens
 
 
-def check_conv_max_len(conv: list=None, max_len:str=None) -> bool:
+class ConvLengthTracker():
+    # running token count of a conversation prefix, turns that were already
+    # counted are never encoded again
+    def __init__(self) -> None:
+        self.num_turns = 0
+        self.num_tokens = 0
+
+    def extend(self, conv: list = None) -> int:
+        for item in conv[self.num_turns:]:
+            # turns are counted as if joined with " ", as check_conv_max_len does
+            text = item["value"] if self.num_turns == 0 else " " + item["value"]
+            self.num_tokens += num_tokens_from_string(text)
+            self.num_turns += 1
+        return self.num_tokens
+
+
+def check_conv_max_len(conv: list=None, max_len:str=None, tracker: ConvLengthTracker=None) -> bool:
+    if tracker is not None:
+        return tracker.extend(conv) >= max_len
     conv=[item["value"] for item in conv]
     cur_len = num_tokens_from_string((" ").join(conv))
     # print(f"current length: {cur_len}")
@@ -63,9 +108,10 @@ def multi_sample2query(sample: dict=None, cur_turn: str=None, conv_wind_size: st
 
 
 def format_mistral_prompt(mem_hist: list=None) -> list:
+    # returns a new list, the messages of mem_hist may be shared with agent memory
     if mem_hist[0]["role"] == "system":
-        mem_hist[1]["content"] = mem_hist[0]["content"] + "\n\n" + mem_hist[1]["content"]
-        return mem_hist[1:]
+        first_mem = dict(mem_hist[1], content=mem_hist[0]["content"] + "\n\n" + mem_hist[1]["content"])
+        return [first_mem] + mem_hist[2:]
     return mem_hist
 
 
@@ -199,6 +245,55 @@ def get_res_path(args) -> str:
     return res_pref
 
 
+def get_manifest_path(res_pref: str = None) -> str:
+    return os.path.join(os.path.dirname(res_pref), "_manifest.jsonl")
+
+
+def read_res_status(res_name: str = None) -> str:
+    # status of a result file without a manifest entry: written before the
+    # manifest existed, or the job died before appending its entry
+    try:
+        with open(res_name, 'r') as f:
+            res_dict = json.load(f)
+    except (OSError, ValueError):
+        # torn by a killed job
+        return "error"
+    return "error" if "edit_error" in res_dict else "ok"
+
+
+def load_completed_ids(res_pref: str = None) -> set:
+    # result files are named "<rq>_<id>.json", so a single directory scan over
+    # names tells which samples have results; the manifest gives their status
+    # and only the files it does not know are opened
+    res_dir = os.path.dirname(res_pref)
+    latest = {}
+    with os.scandir(res_dir) as entries:
+        f_names = sorted(entry.name for entry in entries)
+    for f_name in f_names:
+        if f_name.endswith(".json") and "_" in f_name:
+            # a resumed sample has several files, the latest one counts
+            latest[f_name[f_name.index("_")+1:-5]] = f_name
+    status = {}
+    file_status = {}
+    manifest_path = get_manifest_path(res_pref)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line may be torn if the job was killed while writing
+                    continue
+                status[str(entry["id"])] = entry["status"]
+                file_status[entry["file"]] = entry["status"]
+    for sample_id, f_name in latest.items():
+        if f_name in file_status:
+            status[sample_id] = file_status[f_name]
+        else:
+            status[sample_id] = read_res_status(os.path.join(res_dir, f_name))
+    return {sample_id for sample_id, s in status.items() if s == "ok"}
+
+
 def get_error_path(args) -> str:
     save_folder_name = args.save_folder_name
     rq = time.strftime('%Y%m%d%H%M', time.localtime(time.time()))